@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""Benchmarks of the Module M decoder and the D-Bus publish path.
+
+    python3 tests/benchmark.py                          run and print the results
+    python3 tests/benchmark.py --save                   store the results as the baseline of this machine
+    python3 tests/benchmark.py --compare                compare with that baseline, exit 1 on a regression
+    python3 tests/benchmark.py --compare other.json     compare with another baseline
+
+Numbers from different machines can not be compared, so the baselines are kept
+per CPU architecture next to this script as benchmark-baseline-<machine>.json,
+with the CPU and Python version they were taken with. benchmark-baseline-x86_64.json
+comes from a development PC. The GX baseline is benchmark-baseline-armv7l.json:
+take it on the GX with --save from the release it should guard and commit it,
+then run --compare there before deploying a new venus-data.tgz. Every benchmark
+is repeated and the best run counts, peak memory is measured with tracemalloc in
+a separate run.
+
+--compare refuses a baseline taken with another Python version (--any-python
+overrides it), and a benchmark of the baseline without a result fails it. Peak
+memory regresses when it grows by more than the threshold and --memory-floor kB,
+the decoder peaks are small enough for a few allocations to make 10%.
+
+The publish benchmarks run DbusENERTYService against StubDbusService (service_stub.py)
+instead of VeDbusService, they need GLib and velib_python like the service itself and are
+skipped when those can not be imported.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+MODULE_M_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'venus-data', 'module_m')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'benchmark-baseline-{platform.machine()}.json')
+sys.path.insert(1, MODULE_M_DIR)
+
+from module_m_decoder import ModuleM # noqa: E402
+from service_stub import load_service # noqa: E402
+
+FRAME = struct.Struct("=2B3?9I2I")
+FRAMES = 20000
+
+
+def _frame(sequence: int) -> bytes:
+    return FRAME.pack(42, ord('D'), sequence % 3 == 0, False, False, sequence, 2000, 3000,
+                      230000, 231000, 229000, sequence % 5000000, 460000, 690000, sequence, sequence // 2)
+
+
+def _stream(garbage: float = 0.0) -> bytes:
+    """*B registration followed by FRAMES *D frames, garbage is the share of random bytes in between"""
+    random.seed(1)
+    parts = [b'*B' + b'BENCH000001']
+    for sequence in range(FRAMES):
+        if garbage:
+            noise = bytes(random.randrange(256) for _ in range(int(FRAME.size * garbage / (1 - garbage))))
+            parts.append(noise.replace(b'*', b'+')) # no false magic starts, every frame stays decodable
+        parts.append(_frame(sequence))
+    return b''.join(parts)
+
+
+class MemorySerial:
+    """Just enough of serial.Serial for ModuleM._read_data, serves a byte stream in reads of chunk bytes"""
+
+    def __init__(self, data: bytes, chunk: int) -> None:
+        self.data = memoryview(data)
+        self.chunk = chunk
+        self.offset = 0
+        self.port = 'benchmark'
+        self.is_open = True
+
+    @property
+    def in_waiting(self) -> int:
+        return min(self.chunk, len(self.data) - self.offset)
+
+    def readinto(self, buffer) -> int:
+        count = min(len(buffer), len(self.data) - self.offset)
+        buffer[:count] = self.data[self.offset:self.offset + count]
+        self.offset += count
+        return count
+
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        self.is_open = False
+
+
+def bench_decode(stream: bytes, chunk: int):
+    """Frames per second decoded from stream fed in reads of chunk bytes"""
+    def run():
+        module_m = ModuleM()
+        view = memoryview(stream)
+        for offset in range(0, len(view), chunk):
+            module_m.feed(view[offset:offset + chunk])
+        assert module_m.frames_decoded == FRAMES, module_m.frames_decoded
+        module_m.discovery.close()
+        return FRAMES
+    return run
+
+
+def bench_read_frames(stream: bytes, chunk: int):
+    """Frames per second through the polling path: in_waiting, readinto, resync and decode"""
+    def run():
+        ser = MemorySerial(stream, chunk)
+        module_m = ModuleM(ser)
+        while ser.offset < len(stream):
+            module_m.read_frames()
+        assert module_m.frames_decoded == FRAMES, module_m.frames_decoded
+        module_m.discovery.close()
+        return FRAMES
+    return run
+
+
+def bench_publish(service_module, changing: bool):
+    """Ticks per second of DbusENERTYService._publish, with a new sample per tick or the same one"""
+    def run():
+        config = service_module.load_config(os.devnull)
+        config.read_dict({'journal': {'path': os.path.join(tempfile.gettempdir(), 'benchmark.journal')}})
+        service = service_module.DbusENERTYService('com.victronenergy.grid.benchmark', 0, config=config)
+        module_m = service.module_m
+        module_m.feed(b'*B' + b'BENCH000001')
+        ticks = 5000
+        for tick in range(ticks):
+            if changing or tick == 0:
+                module_m.feed(_frame(tick))
+            service._publish()
+        service.close()
+        module_m.discovery.close()
+        return ticks
+    return run
+
+
+def measure(run, repeat: int) -> dict:
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        count = run()
+        seconds = time.perf_counter() - started
+        if best is None or seconds < best[1]:
+            best = (count, seconds)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'per_second': best[0] / best[1], 'us_per_op': best[1] / best[0] * 1e6, 'peak_kb': peak / 1024}
+
+
+def benchmarks() -> dict:
+    clean = _stream()
+    garbage = _stream(garbage=0.5)
+    suite = {
+        'decode_clean_4096': bench_decode(clean, 4096),
+        'decode_garbage_4096': bench_decode(garbage, 4096),
+        'decode_fragmented_7': bench_decode(clean, 7),
+        'read_frames_clean_4096': bench_read_frames(clean, 4096),
+        'read_frames_fragmented_7': bench_read_frames(clean, 7),
+    }
+    try:
+        service_module = load_service()
+    except ImportError as e:
+        print(f"skipping the publish benchmarks: {e}", file=sys.stderr)
+    else:
+        suite['publish_changing'] = bench_publish(service_module, changing=True)
+        suite['publish_unchanged'] = bench_publish(service_module, changing=False)
+    return suite
+
+
+def _cpu() -> str:
+    try:
+        with open('/proc/cpuinfo') as file:
+            for line in file:
+                name, _, value = line.partition(':')
+                if name.strip() in ('model name', 'Hardware'):
+                    return value.strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def compare(results: dict, baseline: dict, threshold: float, memory_floor: float, only: list = None) -> bool:
+    """Print a comparison table, returns True when a benchmark regressed more than threshold or did not run
+
+    Peak memory regresses when it grows by more than threshold and memory_floor kB.
+    only limits the baseline benchmarks that have to have a result, like --only.
+    """
+    regressed = False
+    print(f"{'benchmark':28} {'baseline/s':>12} {'now/s':>12} {'change':>8} {'peak kB':>14}")
+    for name, base in baseline.get('results', {}).items():
+        if name not in results and (not only or name in only):
+            print(f"{name:28} {base['per_second']:12.0f} {'-':>12} {'missing':>8} {'':14}  NO RESULT")
+            regressed = True
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print(f"{name:28} {'-':>12} {result['per_second']:12.0f} {'new':>8} {result['peak_kb']:14.1f}")
+            continue
+        change = result['per_second'] / base['per_second'] - 1
+        memory_growth = result['peak_kb'] - base['peak_kb']
+        memory_change = memory_growth / base['peak_kb'] if base['peak_kb'] else 0.0
+        flag = ''
+        if change < -threshold or (memory_change > threshold and memory_growth > memory_floor):
+            flag = '  REGRESSION'
+            regressed = True
+        print(f"{name:28} {base['per_second']:12.0f} {result['per_second']:12.0f} {change:+8.1%} "
+              f"{base['peak_kb']:6.1f}->{result['peak_kb']:6.1f}{flag}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Module M decoder and publish path benchmarks')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append', help='run only this benchmark, can be repeated')
+    parser.add_argument('--save', nargs='?', const=BASELINE, help=f'write the results to this JSON baseline, {os.path.basename(BASELINE)} by default')
+    parser.add_argument('--compare', nargs='?', const=BASELINE, help=f'compare with this JSON baseline, {os.path.basename(BASELINE)} by default')
+    parser.add_argument('--threshold', type=float, default=0.10, help='allowed slowdown / memory growth, 0.10 is 10%%')
+    parser.add_argument('--memory-floor', type=float, default=64, help='peak memory growth in kB that is never a regression')
+    parser.add_argument('--any-python', action='store_true', help='compare with a baseline of another Python version')
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.INFO) # the decoder logs the registration of every run
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        python = '.'.join(platform.python_version_tuple()[:2])
+        if '.'.join(str(baseline.get('python')).split('.')[:2]) != python and not args.any_python:
+            print(f"error: baseline from Python {baseline.get('python')}, running on Python {platform.python_version()}; "
+                  f"run the benchmark with the Python of the baseline or pass --any-python", file=sys.stderr)
+            sys.exit(2)
+
+    results = {}
+    for name, run in benchmarks().items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure(run, args.repeat)
+        print(f"{name:28} {results[name]['per_second']:12.0f}/s {results[name]['us_per_op']:8.2f} us "
+              f"{results[name]['peak_kb']:8.1f} kB peak", file=sys.stderr)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': platform.machine(),
+        'cpu': _cpu(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+            file.write('\n')
+    if baseline is not None:
+        if baseline.get('python') != report['python']:
+            print(f"WARNING: baseline from Python {baseline.get('python')}, running on Python {report['python']}", file=sys.stderr)
+        if baseline.get('machine') != report['machine']:
+            print(f"warning: baseline from {baseline.get('machine')}, running on {report['machine']}", file=sys.stderr)
+        sys.exit(1 if compare(results, baseline, args.threshold, args.memory_floor, args.only) else 0)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Module M emulator on a pseudo-terminal, with fault injection.
+
+The emulator answers *A with *B and a serial number and then streams *D (or *C)
+frames at any rate, a pty has no baud rate limit. The slave side of the pty is
+linked to --link, so the service can be pointed at it:
+
+    python3 tests/module_m_emulator.py serve --rate 10
+    python3 venus-data/module_m/dbus-homemanager.py --port /tmp/module_m_emulator
+
+Faults are injected with inject() or typed on stdin in serve mode:
+    noise [bytes]       random bytes between two frames
+    split [pieces]      the next frame is written in pieces with a short pause in between
+    drop [bytes]        bytes are removed from the next frame
+    burst [frames]      frames written at once
+    errors [lines]      a *E frame with error lines
+    disconnect [sec]    the pty is closed and a new one is opened after sec seconds
+
+The latency mode runs DbusENERTYService in this process, with the GLib main loop
+and StubDbusService (service_stub.py) instead of VeDbusService like tests/benchmark.py, so every
+frame goes through the mapping, the deadbands, the energy integrator and the
+history. It reports the frame to D-Bus latency and the recovery time after a
+disconnect, and needs GLib and velib_python like the service:
+
+    python3 tests/module_m_emulator.py latency --rate 200 --seconds 10 --fault noise --fault disconnect
+"""
+import argparse
+import os
+import queue
+import random
+import select
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+MODULE_M_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'venus-data', 'module_m')
+sys.path.insert(1, MODULE_M_DIR)
+
+from service_stub import load_service # noqa: E402
+
+AMPS_AND_VOLTAGE = struct.Struct("=2B3?9I")
+AMPS_VOLTAGE_AND_ENERGY = struct.Struct("=2B3?9I2I")
+
+
+class ModuleMEmulator:
+
+    def __init__(self, link: str = '/tmp/module_m_emulator', rate: float = 10.0, serialnumber: bytes = b'EMU00000001',
+                 energy: bool = True, registration: bool = True) -> None:
+        self.link = link
+        self.rate = rate # frames per second
+        self.serialnumber = serialnumber[:11].ljust(11, b'0')
+        self.energy = energy # send *D instead of *C frames
+        self.registration = registration # only stream after *A, like the real Module M
+        self.sequence = 0 # sent as I1, identifies the frame in latency measurements
+        self.sent = {} # sequence -> time.monotonic() the frame was written
+        self.reconnected_at = None # time.monotonic() the last disconnect ended
+        self.registered = False
+        self.energy_forward = 0
+        self.energy_reverse = 0
+        self._faults = queue.Queue()
+        self._master = None
+        self._slave = None
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._open()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self._close()
+        if os.path.islink(self.link):
+            os.unlink(self.link)
+
+    def inject(self, fault: str, amount: float = None):
+        """Queue a fault, it is applied before the next frame"""
+        self._faults.put((fault, amount))
+
+    def _open(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        name = os.ttyname(self._slave)
+        if os.path.islink(self.link):
+            os.unlink(self.link)
+        os.symlink(name, self.link)
+        self.registered = False
+
+    def _close(self):
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def _write(self, data: bytes):
+        try:
+            os.write(self._master, data)
+        except (BlockingIOError, OSError): # nobody reads the pty, the frame is lost like on a real line
+            pass
+
+    def _frame(self) -> bytes:
+        self.sequence += 1
+        power = random.randint(0, 5000000) # mW
+        export = random.random() < 0.3
+        self.energy_forward += 0 if export else 1
+        self.energy_reverse += 1 if export else 0
+        values = (42, ord('D') if self.energy else ord('C'), export, False, False,
+                  self.sequence, 2000, 3000, 230000, 231000, 229000, power, 460000, 690000)
+        if self.energy:
+            return AMPS_VOLTAGE_AND_ENERGY.pack(*values, self.energy_forward, self.energy_reverse)
+        return AMPS_AND_VOLTAGE.pack(*values)
+
+    def _send_frame(self, split: int = 1, drop: int = 0):
+        frame = bytearray(self._frame())
+        for _ in range(min(drop, len(frame))):
+            del frame[random.randrange(len(frame))]
+        self.sent[self.sequence] = time.monotonic()
+        size = max(1, len(frame) // split)
+        for start in range(0, len(frame), size):
+            self._write(bytes(frame[start:start + size]))
+            if start + size < len(frame):
+                time.sleep(0.005)
+
+    def _handle_request(self):
+        try:
+            request = os.read(self._master, 1024)
+        except (BlockingIOError, OSError):
+            return
+        if b'*A' in request:
+            self._write(b'*B' + self.serialnumber)
+            self.registered = True
+
+    def _apply_faults(self):
+        split = 1
+        drop = 0
+        while not self._faults.empty():
+            fault, amount = self._faults.get()
+            if fault == 'noise':
+                self._write(bytes(random.randrange(256) for _ in range(int(amount or 32))))
+            elif fault == 'split':
+                split = int(amount or 4)
+            elif fault == 'drop':
+                drop = int(amount or 3)
+            elif fault == 'burst':
+                for _ in range(int(amount or 50)):
+                    self.sent[self.sequence + 1] = time.monotonic()
+                    self._write(self._frame())
+            elif fault == 'errors':
+                lines = [f"emulated error {line}".encode() for line in range(int(amount or 2))]
+                self._write(b'*E' + bytes([len(lines)]) + b''.join(line + b'\r\n' for line in lines))
+            elif fault == 'disconnect':
+                self._close()
+                time.sleep(amount if amount is not None else 2)
+                self._open()
+                self.reconnected_at = time.monotonic()
+            else:
+                print(f"unknown fault {fault}", file=sys.stderr)
+        return split, drop
+
+    def _run(self):
+        next_frame = time.monotonic()
+        while self._running:
+            timeout = max(0.0, next_frame - time.monotonic())
+            readable, _, _ = select.select([self._master], [], [], timeout)
+            if readable:
+                self._handle_request()
+            if time.monotonic() < next_frame:
+                continue
+            next_frame += 1 / self.rate
+            if time.monotonic() - next_frame > 1: # fell behind, e.g. after a disconnect
+                next_frame = time.monotonic()
+            split, drop = self._apply_faults()
+            if self.registered or not self.registration:
+                self._send_frame(split, drop)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure_latency(emulator: ModuleMEmulator, seconds: float, faults=()) -> dict:
+    """Run DbusENERTYService on the emulator pty in the GLib main loop, faults are spread over the run.
+
+    The latency of a frame ends with the D-Bus batch that publishes it, the frame is
+    recognised by the sequence number it carries in I1.
+    """
+    service_module = load_service()
+    GLib = service_module.gobject
+    config = service_module.load_config(os.devnull)
+    config.read_dict({'journal': {'path': os.path.join(tempfile.gettempdir(), 'module_m_emulator.journal')}})
+    service = service_module.DbusENERTYService('com.victronenergy.grid.emulator', 0, config=config, port=emulator.link)
+    latencies = []
+    recovery = []
+    last_sequence = None
+
+    def on_signal():
+        nonlocal last_sequence
+        now = time.monotonic()
+        sequence = service.module_m.mmdata.I1
+        sent = emulator.sent.get(sequence)
+        if sent is None or sequence == last_sequence: # a zeroed sample or a batch of the watchdog
+            return
+        last_sequence = sequence
+        latencies.append(now - sent)
+        reconnected_at = emulator.reconnected_at
+        if reconnected_at is not None and sent >= reconnected_at and (not recovery or recovery[-1][0] != reconnected_at):
+            recovery.append((reconnected_at, now - reconnected_at))
+
+    service._dbusservice.on_signal = on_signal
+    context = GLib.MainContext.default()
+    wakeup = GLib.timeout_add(100, lambda: True) # the faults are injected between two iterations
+    started = time.monotonic()
+    fault_times = [started + seconds * (index + 1) / (len(faults) + 1) for index in range(len(faults))]
+    faults = list(faults)
+    while time.monotonic() - started < seconds:
+        if faults and time.monotonic() >= fault_times[0]:
+            fault_times.pop(0)
+            emulator.inject(*faults.pop(0))
+        context.iteration(True)
+    GLib.source_remove(wakeup)
+    module_m = service.module_m
+    service.close()
+    module_m.ser.close()
+    module_m.discovery.close()
+    return {
+        'frames_sent': emulator.sequence,
+        'frames_decoded': module_m.frames_decoded,
+        'frames_coalesced': module_m.frames_coalesced,
+        'frames_skipped': module_m.frames_skipped,
+        'bytes_discarded': module_m.bytes_discarded,
+        'latency_ms_p50': _percentile(latencies, 0.5) * 1000,
+        'latency_ms_p99': _percentile(latencies, 0.99) * 1000,
+        'latency_ms_max': max(latencies, default=float('nan')) * 1000,
+        'recovery_seconds': [round(seconds, 3) for _, seconds in recovery],
+        'service_publish_latency_ms_p99': service_module._milliseconds(service.publish_latency.quantile(0.99)), # bucket bound
+        'connection': str(module_m.connection),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Module M emulator on a pseudo-terminal')
+    parser.add_argument('mode', choices=('serve', 'latency'))
+    parser.add_argument('--link', default='/tmp/module_m_emulator', help='symlink to the pty slave')
+    parser.add_argument('--rate', type=float, default=10, help='frames per second')
+    parser.add_argument('--no-energy', action='store_true', help='send *C instead of *D frames')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of the latency run')
+    parser.add_argument('--fault', action='append', default=[], help='fault for the latency run, e.g. noise or disconnect:1')
+    args = parser.parse_args()
+
+    emulator = ModuleMEmulator(args.link, args.rate, energy=not args.no_energy)
+    emulator.start()
+    try:
+        if args.mode == 'serve':
+            print(f"Module M emulator on {args.link} -> {os.readlink(args.link)}, type a fault and enter")
+            for line in sys.stdin:
+                words = line.split()
+                if words:
+                    emulator.inject(words[0], float(words[1]) if len(words) > 1 else None)
+        else:
+            faults = []
+            for fault in args.fault:
+                name, _, amount = fault.partition(':')
+                faults.append((name, float(amount) if amount else None))
+            for name, value in measure_latency(emulator, args.seconds, faults).items():
+                print(f"{name}: {value}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
@@ -0,0 +1,48 @@
+"""StubDbusService and load_service() for the scripts that run DbusENERTYService without D-Bus.
+
+    from service_stub import load_service
+    service_module = load_service()
+    service = service_module.DbusENERTYService('com.victronenergy.grid.test', 0, config=config)
+
+load_service() imports dbus-homemanager.py with VeDbusService replaced by
+StubDbusService. It still needs GLib and velib_python like the service itself
+and raises ImportError when those can not be imported.
+"""
+import importlib.util
+import os
+
+MODULE_M_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'venus-data', 'module_m')
+
+
+class StubDbusService(dict):
+    """Stands in for VeDbusService: add_path, item access and the batching with block
+
+    Every with block counts as one ItemsChanged signal, which is when velib sends it:
+    signals counts them and on_signal is called after each one.
+    """
+
+    def __init__(self, servicename=None, *args, **kwargs) -> None:
+        super().__init__()
+        self.signals = 0
+        self.on_signal = None
+
+    def add_path(self, path, value, *args, **kwargs):
+        self[path] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.signals += 1
+        if self.on_signal is not None:
+            self.on_signal()
+        return False
+
+
+def load_service():
+    """dbus-homemanager.py as a module, with StubDbusService instead of VeDbusService"""
+    spec = importlib.util.spec_from_file_location('dbus_homemanager', os.path.join(MODULE_M_DIR, 'dbus-homemanager.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.VeDbusService = StubDbusService
+    return module
@@ -4,10 +4,9 @@
 import platform
 import os
 import sys
-import threading
 import socket
 import struct
-import select
+import time
 
 
 from gi.repository import GLib as gobject
@@ -15,16 +14,23 @@ from gi.repository import GLib as gobject
 # our own packages from victron
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
 from vedbus import VeDbusService
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'venus-data', 'module_m'))
+import speedwire
+from dbus_publisher import DbusPublisher
 
 
 
 
-def sma_receiver_thread() :
-    
+MCAST_GRP = speedwire.MULTICAST_GROUP
+MCAST_PORT = speedwire.PORT
+TIMEOUT = 2 # seconds without datagrams before the power is set to zero
+
+_buffer = bytearray(speedwire.MAX_DATAGRAM) # every datagram is received into this buffer
+_last_received = time.monotonic()
+
+
+def open_socket():
     ipbind = '0.0.0.0'
-    MCAST_GRP = '239.12.255.254'
-    MCAST_PORT = 9522
-            
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind(('', MCAST_PORT))
@@ -34,60 +40,33 @@ def sma_receiver_thread() :
     except BaseException:
         print('could not connect to mulicast group or bind to given interface')
         sys.exit(1)
+    sock.setblocking(False)
+    return sock
 
-    while True:
-        ready = select.select([sock], [], [], 2)
 
-        if ready[0] == []:
-            _dbusservice['/Ac/L1/Power'] = 0 # set power to zero if timeout
-            _dbusservice['/Ac/L2/Power'] = 0 # set power to zero if timeout
-            _dbusservice['/Ac/L3/Power'] = 0 # set power to zero if timeout
-            _dbusservice['/Ac/Power'] = 0 # set power to zero if timeout
-            continue
- 
-        b = sock.recv(608)
-            
+def on_datagram(fd, condition, sock):
+    global _last_received
+    while True:
+        try:
+            length = sock.recv_into(_buffer)
+        except BlockingIOError:
+            return True # keep watching
         try:
-            if len(b) < 500: # too short
-                continue
-                
-            if int.from_bytes(b[16:18], byteorder='big') != 0x6069 : # wrong protocol?
-                continue
-                
-            if int.from_bytes(b[20:24], byteorder='big') == 0xffffffff : # wrong serial?
-                continue  
-                
-            _dbusservice['/Ac/Power'] = (int.from_bytes(b[32:36], byteorder='big') - int.from_bytes(b[52:56], byteorder='big')) / 10
-            _dbusservice['/Ac/Energy/Forward'] = int.from_bytes(b[40:48], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/Energy/Reverse'] = int.from_bytes(b[60:68], byteorder='big') / 3600 / 1000
-            
-            offset = 164
-            _dbusservice['/Ac/L1/Energy/Forward'] = int.from_bytes(b[offset + 12:offset + 20], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L1/Energy/Reverse'] = int.from_bytes(b[offset + 32:offset + 40], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L1/Power'] = (int.from_bytes(b[offset + 4:offset + 8], byteorder='big') - int.from_bytes(b[offset + 24:offset + 28], byteorder='big')) / 10
-            _dbusservice['/Ac/L1/Voltage'] = int.from_bytes(b[offset + 132:offset + 136], byteorder='big') / 1000
-            _dbusservice['/Ac/L1/Current'] = _dbusservice['/Ac/L1/Power'] / _dbusservice['/Ac/L1/Voltage']
-
-            offset = 308
-            _dbusservice['/Ac/L2/Energy/Forward'] = int.from_bytes(b[offset + 12:offset + 20], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L2/Energy/Reverse'] = int.from_bytes(b[offset + 32:offset + 40], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L2/Power'] = (int.from_bytes(b[offset + 4:offset + 8], byteorder='big') - int.from_bytes(b[offset + 24:offset + 28], byteorder='big')) / 10
-            _dbusservice['/Ac/L2/Voltage'] = int.from_bytes(b[offset + 132:offset + 136], byteorder='big') / 1000
-            _dbusservice['/Ac/L2/Current'] = _dbusservice['/Ac/L2/Power'] / _dbusservice['/Ac/L2/Voltage']
-            
-            offset = 452
-            _dbusservice['/Ac/L3/Energy/Forward'] = int.from_bytes(b[offset + 12:offset + 20], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L3/Energy/Reverse'] = int.from_bytes(b[offset + 32:offset + 40], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L3/Power'] = (int.from_bytes(b[offset + 4:offset + 8], byteorder='big') - int.from_bytes(b[offset + 24:offset + 28], byteorder='big')) / 10
-            _dbusservice['/Ac/L3/Voltage'] = int.from_bytes(b[offset + 132:offset + 136], byteorder='big') / 1000
-            _dbusservice['/Ac/L3/Current'] = _dbusservice['/Ac/L3/Power'] / _dbusservice['/Ac/L3/Voltage']
-            
-            _dbusservice['/Ac/Current'] = _dbusservice['/Ac/L1/Current'] + _dbusservice['/Ac/L2/Current'] + _dbusservice['/Ac/L3/Current']
-            
-            _dbusservice['/Serial'] = int.from_bytes(b[20:24], byteorder='big')
-        except:
-            print('error parsing energy meter values')   
-        
+            serial, records = speedwire.parse(_buffer, length)
+        except speedwire.SpeedwireError: # inverters use the same group
+            continue
+        _last_received = time.monotonic()
+        values = speedwire.dbus_values(records)
+        values['/Serial'] = serial
+        _publisher.publish(values)
+
+
+def check_timeout():
+    if time.monotonic() - _last_received > TIMEOUT:
+        # set power to zero if timeout
+        _publisher.publish({'/Ac/L1/Power': 0, '/Ac/L2/Power': 0, '/Ac/L3/Power': 0, '/Ac/Power': 0})
+    return True
+
 from dbus.mainloop.glib import DBusGMainLoop
 # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
 DBusGMainLoop(set_as_default=True)
@@ -164,9 +143,11 @@ for path, settings in paths.items():
         path, settings['initial'], gettextcallback=settings['textformat'], writeable=True)
 
 
-receive_thread = threading.Thread(target=sma_receiver_thread)
-receive_thread.daemon = True
-receive_thread.start() 
+# the datagrams are handled in the main loop, one batched ItemsChanged per datagram
+_publisher = DbusPublisher(_dbusservice)
+_sock = open_socket()
+gobject.io_add_watch(_sock.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN, on_datagram, _sock)
+gobject.timeout_add(1000, check_timeout)
 
     
 mainloop = gobject.MainLoop()
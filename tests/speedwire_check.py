@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Checks speedwire.py against a datagram in the layout the SMA meters send, both ways.
+
+    python3 tests/speedwire_check.py
+
+DATAGRAM is a Home Manager 2.0 datagram written out byte by byte, not produced
+by speedwire.py: every record header is 00 <measurement> <type> 00, e.g.
+00 01 04 00 for the total active power import and 00 15 04 00 for the one of
+L1. The values are also read with the fixed offsets the offset reader used
+before speedwire.py, so the parser is checked against a second reading.
+
+The datagrams encode() sends are compared with DATAGRAM byte by byte: the same
+block headers, the same record headers in the same order (ours leave out the
+reactive and apparent power) and the totals at the offsets a meter has them.
+"""
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'venus-data', 'module_m'))
+import speedwire # noqa: E402
+
+DATAGRAM = bytes.fromhex(''.join((
+    # signature, group tag, data tag (length 0x024c), protocol 0x6069, SUSy id 0x0174, serial, ticker
+    '534d4100', '000402a0', '00000001', '024c0010', '60690174', 'b3161152', '075bcd15',
+    # total: active power +/- (1.4.0 / 2.4.0 in 0.1 W, 1.8.0 / 2.8.0 in Ws), reactive, apparent
+    '0001040000000c35000108000000000a7a358200',
+    '000204000000000000020800000000006b49d200',
+    '000304000000019c0003080000000000aba95000',
+    '0004040000000000000408000000000015752a00',
+    '0009040000000cb4000908000000000d693a4000',
+    '000a040000000000000a08000000000080befc00',
+    # power factor, frequency
+    '000d0400000003c1000e04000000c341',
+    # L1, current 31.4.0 in mA, voltage 32.4.0 in mV, power factor
+    '00150400000007d000150800000000037e11d600',
+    '0016040000000000001608000000000023c34600',
+    '00170400000000fa001708000000000039387000',
+    '0018040000000000001808000000000007270e00',
+    '001d0400000007e0001d0800000000047868c000',
+    '001e040000000000001e0800000000002aea5400',
+    '001f0400000021fc002004000003846400210400000003e0',
+    # L2
+    '00290400000005dc002908000000000430e23400',
+    '002a040000000000002a08000000000011e1a300',
+    '002b0400000000a2002b08000000000047868c00',
+    '002c040000000000002c080000000000055d4a80',
+    '00310400000005e500310800000000050775d800',
+    '00320400000000000032080000000000202fbf00',
+    '0033040000001982003404000003872000350400000003e2',
+    # L3, exporting
+    '003d040000000000003d080000000002cb417800',
+    '003e040000000177003e08000000000035a4e900',
+    '003f040000000000003f0800000000002aea5400',
+    '0040040000000000004008000000000008f0d180',
+    '00450400000000000045080000000003e95ba800',
+    '00460400000001ac004608000000000035a4e900',
+    '0047040000000744004804000003820c004904000000036c',
+    # software version 2.0.18.R, end
+    '9000000002001252', '00000000',
+)))
+
+EXPECTED = {
+    '/Ac/Power': 312.5,
+    '/Ac/Energy/Forward': 12500.0,
+    '/Ac/Energy/Reverse': 500.0,
+    '/Ac/Current': 17.09,
+    '/Ac/L1/Power': 200.0,
+    '/Ac/L1/Energy/Forward': 4166.667,
+    '/Ac/L1/Energy/Reverse': 166.667,
+    '/Ac/L1/Current': 8.7,
+    '/Ac/L1/Voltage': 230.5,
+    '/Ac/L2/Power': 150.0,
+    '/Ac/L2/Energy/Forward': 5000.0,
+    '/Ac/L2/Energy/Reverse': 83.333,
+    '/Ac/L2/Current': 6.53,
+    '/Ac/L2/Voltage': 231.2,
+    '/Ac/L3/Power': -37.5,
+    '/Ac/L3/Energy/Forward': 3333.333,
+    '/Ac/L3/Energy/Reverse': 250.0,
+    '/Ac/L3/Current': 1.86,
+    '/Ac/L3/Voltage': 229.9,
+}
+
+
+def _offset_reader(b: bytes) -> dict:
+    """The values at the fixed offsets of the energy meter layout, as the offset reader read them"""
+    def number(start, end):
+        return int.from_bytes(b[start:end], byteorder='big')
+    values = {
+        '/Ac/Power': (number(32, 36) - number(52, 56)) / 10,
+        '/Ac/Energy/Forward': number(40, 48) / 3600 / 1000,
+        '/Ac/Energy/Reverse': number(60, 68) / 3600 / 1000,
+    }
+    for phase, offset in (('L1', 164), ('L2', 308), ('L3', 452)):
+        values[f'/Ac/{phase}/Power'] = (number(offset + 4, offset + 8) - number(offset + 24, offset + 28)) / 10
+        values[f'/Ac/{phase}/Energy/Forward'] = number(offset + 12, offset + 20) / 3600 / 1000
+        values[f'/Ac/{phase}/Energy/Reverse'] = number(offset + 32, offset + 40) / 3600 / 1000
+        values[f'/Ac/{phase}/Voltage'] = number(offset + 132, offset + 136) / 1000
+    return values
+
+
+def _check(values: dict, expected: dict, what: str):
+    for path, value in expected.items():
+        if path not in values or abs(values[path] - value) > 0.001:
+            raise AssertionError(f"{what}: {path} is {values.get(path)}, expected {value}")
+
+
+def _headers(data: bytes) -> list:
+    """Record headers of a datagram as hex strings, walked with the record sizes of the layout"""
+    headers = []
+    offset = 28
+    while data[offset:offset + 4] != bytes(4):
+        header = data[offset:offset + 4]
+        headers.append(header.hex())
+        offset += 12 if header[2] == 8 else 8
+    return headers
+
+
+def check_parse():
+    assert len(DATAGRAM) == 608
+    assert DATAGRAM[28:32] == bytes.fromhex('00010400') and DATAGRAM[164:168] == bytes.fromhex('00150400')
+    serial, records = speedwire.parse(DATAGRAM)
+    assert serial == 3004567890, serial
+    assert records[0x90000000] == 0x02001252
+    values = speedwire.dbus_values(records)
+    assert set(values) == set(EXPECTED), sorted(set(values) ^ set(EXPECTED))
+    _check(values, EXPECTED, 'speedwire.parse')
+    _check(values, _offset_reader(DATAGRAM), 'offset reader')
+    # a receive buffer is larger than the datagram
+    buffer = bytearray(speedwire.MAX_DATAGRAM)
+    buffer[:len(DATAGRAM)] = DATAGRAM
+    assert speedwire.parse(buffer, len(DATAGRAM)) == (serial, records)
+
+
+def check_encode():
+    from module_m_decoder import VictronSerialAmpsAndVoltage
+    sample = VictronSerialAmpsAndVoltage(command=ord('D'), export_CT3=True, I1=8700, I2=6530, I3=1860,
+                                         U1=230500, U2=231200, U3=229900, P1=200000, P2=150000, P3=37500,
+                                         energy_forward=12500000, energy_reverse=500000)
+    phase_energy = ((4166666.7, 166666.7), (5000000, 83333.3), (3333333.3, 250000))
+    data = speedwire.encode(sample, 3004567890, 123456789, phase_energy)
+    # signature, group tag and data tag, protocol, SUSy id, serial and ticker of a Home Manager 2.0
+    assert data[:12] == DATAGRAM[:12] and data[14:28] == DATAGRAM[14:28], data[:28].hex()
+    assert int.from_bytes(data[12:14], byteorder='big') == len(data) - 20 # up to the end record
+    assert data[28:32] == bytes.fromhex('00010400'), data[28:32].hex()
+    ours, real = _headers(data), _headers(DATAGRAM)
+    assert ours[-1] == '90000000', ours[-1]
+    assert [header for header in real if header in ours] == ours, ours # a subsequence of the meter records
+    assert '00150400' in ours and '001f0400' in ours and '00200400' in ours
+    totals = {path: value for path, value in EXPECTED.items() if path.count('/') == 2 and path != '/Ac/Current'}
+    _check(_offset_reader(data), totals, 'offset reader on encode()')
+    _check(speedwire.dbus_values(speedwire.parse(data)[1]), EXPECTED, 'encode()')
+
+
+if __name__ == "__main__":
+    check_parse()
+    check_encode()
+    print('ok')
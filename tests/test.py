@@ -5,6 +5,11 @@ import time
 import sys
 import struct
 import select
+import os
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'venus-data', 'module_m'))
+import speedwire
+from dbus_publisher import DbusPublisher
 
 
 _dbusservice = {
@@ -29,12 +34,13 @@ _dbusservice = {
     '/Ac/Current': 0,
     '/Serial': 0
 }
+_publisher = DbusPublisher(_dbusservice) # writes only what changed, like the services
 
 def sma_receiver_thread() :
     
     # ipbind = '0.0.0.0'
-    MCAST_GRP = '239.12.255.254'
-    MCAST_PORT = 9522
+    MCAST_GRP = speedwire.MULTICAST_GROUP
+    MCAST_PORT = speedwire.PORT
             
     try:
         # Create the UDP socket
@@ -60,69 +66,30 @@ def sma_receiver_thread() :
         print(f'Could not connect to multicast group or bind to given interface: {e}')
         sys.exit(1)
 
+    buffer = bytearray(speedwire.MAX_DATAGRAM) # every datagram is received into this buffer
     while True:
         ready = select.select([sock], [], [], 1) # timeout 200ms
 
         if not ready[0]:
             print('timeout')
-            _dbusservice['/Ac/L1/Power'] = 0 # set power to zero if timeout
-            _dbusservice['/Ac/L2/Power'] = 0 # set power to zero if timeout
-            _dbusservice['/Ac/L3/Power'] = 0 # set power to zero if timeout
-            _dbusservice['/Ac/Power'] = 0 # set power to zero if timeout
+            # set power to zero if timeout
+            _publisher.publish({'/Ac/L1/Power': 0, '/Ac/L2/Power': 0, '/Ac/L3/Power': 0, '/Ac/Power': 0})
             continue
  
-        b = sock.recv(608)
-        print(f"Received data: {b}")
+        length = sock.recv_into(buffer)
+        print(f"Received data: {bytes(buffer[:length])}")
 
-            
         try:
-            if len(b) < 500: # too short
-                print('too short')
-                continue
-                
-            if int.from_bytes(b[16:18], byteorder='big') != 0x6069 : # wrong protocol?
-                print('wrong protocol')
-                continue
-                
-            serial = int.from_bytes(b[20:24], byteorder='big')
-            if serial == 0xffffffff : # wrong serial?
-                print('wrong serial')
-                continue
-
-            print('serial number:', serial)
-                
-            _dbusservice['/Ac/Power'] = (int.from_bytes(b[32:36], byteorder='big') - int.from_bytes(b[52:56], byteorder='big')) / 10
-            _dbusservice['/Ac/Energy/Forward'] = int.from_bytes(b[40:48], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/Energy/Reverse'] = int.from_bytes(b[60:68], byteorder='big') / 3600 / 1000
-            
-            offset = 156 # 164 for energy meter, 156 for home manager 2
-            _dbusservice['/Ac/L1/Energy/Forward'] = int.from_bytes(b[offset + 12:offset + 20], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L1/Energy/Reverse'] = int.from_bytes(b[offset + 32:offset + 40], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L1/Power'] = (int.from_bytes(b[offset + 4:offset + 8], byteorder='big') - int.from_bytes(b[offset + 24:offset + 28], byteorder='big')) / 10
-            _dbusservice['/Ac/L1/Voltage'] = int.from_bytes(b[offset + 132:offset + 136], byteorder='big') / 1000
-            _dbusservice['/Ac/L1/Current'] = _dbusservice['/Ac/L1/Power'] / _dbusservice['/Ac/L1/Voltage']
-
-            offset = 300 # 308 for energy meter, 300 for home manager 2
-            _dbusservice['/Ac/L2/Energy/Forward'] = int.from_bytes(b[offset + 12:offset + 20], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L2/Energy/Reverse'] = int.from_bytes(b[offset + 32:offset + 40], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L2/Power'] = (int.from_bytes(b[offset + 4:offset + 8], byteorder='big') - int.from_bytes(b[offset + 24:offset + 28], byteorder='big')) / 10
-            _dbusservice['/Ac/L2/Voltage'] = int.from_bytes(b[offset + 132:offset + 136], byteorder='big') / 1000
-            _dbusservice['/Ac/L2/Current'] = _dbusservice['/Ac/L2/Power'] / _dbusservice['/Ac/L2/Voltage']
-            
-            offset = 444 # 452 for energy meter, 444 for home manager 2
-            _dbusservice['/Ac/L3/Energy/Forward'] = int.from_bytes(b[offset + 12:offset + 20], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L3/Energy/Reverse'] = int.from_bytes(b[offset + 32:offset + 40], byteorder='big') / 3600 / 1000
-            _dbusservice['/Ac/L3/Power'] = (int.from_bytes(b[offset + 4:offset + 8], byteorder='big') - int.from_bytes(b[offset + 24:offset + 28], byteorder='big')) / 10
-            _dbusservice['/Ac/L3/Voltage'] = int.from_bytes(b[offset + 132:offset + 136], byteorder='big') / 1000
-            _dbusservice['/Ac/L3/Current'] = _dbusservice['/Ac/L3/Power'] / _dbusservice['/Ac/L3/Voltage']
-            
-            _dbusservice['/Ac/Current'] = _dbusservice['/Ac/L1/Current'] + _dbusservice['/Ac/L2/Current'] + _dbusservice['/Ac/L3/Current']
-            
-            _dbusservice['/Serial'] = int.from_bytes(b[20:24], byteorder='big')
+            serial, records = speedwire.parse(buffer, length)
+        except speedwire.SpeedwireError as e:
+            print(e)
+            continue
 
-            print(_dbusservice)
-        except:
-            print('error parsing energy meter values')   
+        print('serial number:', serial)
+        values = speedwire.dbus_values(records)
+        values['/Serial'] = serial
+        _publisher.publish(values)
+        print(_dbusservice)
 
 receive_thread = threading.Thread(target=sma_receiver_thread)
 receive_thread.daemon = True
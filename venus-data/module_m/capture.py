@@ -0,0 +1,170 @@
+"""Raw serial captures of Module M, to reproduce field issues without the hardware.
+
+A capture file is a header followed by one record per read or write on the tty:
+
+    header: b'MMCP', uint8 version, double wall time of the start
+    record: uint32 microseconds since the previous record, uint16 length, uint8 direction, data
+
+Record the service with `dbus-homemanager.py --capture FILE`, or stand alone:
+
+    python3 capture.py record FILE
+    python3 capture.py replay FILE [--speed N]
+
+replay feeds the received bytes through a ModuleM decoder in real time, N times
+faster, or as fast as possible with --speed 0, and reports the decoder throughput.
+"""
+import logging
+import struct
+import time
+
+MAGIC = b'MMCP'
+VERSION = 1
+HEADER = struct.Struct("=4sBd")
+RECORD = struct.Struct("=IHB")
+RECEIVED = 0
+SENT = 1
+
+
+class CaptureWriter:
+
+    def __init__(self, path: str, flush_interval: float = 1.0) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self._last = time.monotonic()
+        self._flushed = self._last
+        self.records = 0
+        self.bytes = 0
+
+    def write(self, data, direction: int = RECEIVED, timestamp: float = None):
+        """Append data read (RECEIVED) or written (SENT) at timestamp (time.monotonic())"""
+        if self._file is None:
+            return
+        now = time.monotonic() if timestamp is None else timestamp
+        delta = min(max(int((now - self._last) * 1e6), 0), 0xFFFFFFFF)
+        self._last = now
+        data = memoryview(data)
+        while True: # records hold at most 64 kB
+            chunk = data[:0xFFFF]
+            self._file.write(RECORD.pack(delta, len(chunk), direction))
+            self._file.write(chunk)
+            self.records += 1
+            self.bytes += len(chunk)
+            data = data[len(chunk):]
+            delta = 0
+            if not data:
+                break
+        if now - self._flushed >= self.flush_interval:
+            self._file.flush()
+            self._flushed = now
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class CaptureReader:
+    """Iterates over (seconds since the start, direction, data) of a capture file"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as file:
+            self.data = file.read()
+        if len(self.data) < HEADER.size:
+            raise ValueError(f"{path} is not a Module M capture")
+        magic, version, self.started = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a Module M capture")
+
+    def __iter__(self):
+        data = self.data
+        offset = HEADER.size
+        elapsed = 0.0
+        while offset + RECORD.size <= len(data):
+            delta, length, direction = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + length > len(data):
+                logging.warning("Capture %s ends in a truncated record", self.path)
+                return
+            elapsed += delta / 1e6
+            yield elapsed, direction, data[offset:offset + length]
+            offset += length
+
+
+def replay(path: str, module_m=None, speed: float = 1.0) -> dict:
+    """Feed the received bytes of a capture into module_m (a new ModuleM when None).
+
+    speed 1 replays in real time, 10 ten times faster and 0 as fast as possible.
+    The samples are stamped with the capture time, so integration and history see
+    the original timing at any speed. Returns the decoder counters and the throughput.
+    """
+    if module_m is None:
+        from module_m_decoder import ModuleM
+        module_m = ModuleM()
+    reader = CaptureReader(path)
+    elapsed = 0.0
+    clock = module_m.clock
+    module_m.clock = lambda: elapsed
+    frames = 0
+    received = 0
+    started = time.perf_counter()
+    try:
+        for elapsed, direction, data in reader:
+            if direction != RECEIVED:
+                continue
+            if speed > 0:
+                delay = elapsed / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            frames += module_m.feed(data)
+            received += len(data)
+    finally:
+        module_m.clock = clock
+    seconds = time.perf_counter() - started
+    return {
+        'frames': frames,
+        'bytes': received,
+        'capture_seconds': elapsed,
+        'replay_seconds': seconds,
+        'frames_per_second': frames / seconds if seconds else 0.0,
+        'bytes_per_second': received / seconds if seconds else 0.0,
+        'frames_skipped': module_m.frames_skipped,
+        'bytes_discarded': module_m.bytes_discarded,
+        'errors': module_m.errors,
+        'serialnumber': module_m.serialnumber,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import select
+    import module_m_logging
+    from module_m_decoder import ModuleM
+
+    parser = argparse.ArgumentParser(description='Record or replay a raw Module M serial capture')
+    parser.add_argument('command', choices=('record', 'replay'))
+    parser.add_argument('file')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed, 1 is real time, 0 as fast as possible')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    module_m_logging.setup_logging(args.log_level.upper())
+
+    if args.command == 'replay':
+        for name, value in replay(args.file, speed=args.speed).items():
+            print(f"{name}: {value}")
+    else:
+        module_m = ModuleM()
+        module_m.start_capture(args.file)
+        try:
+            while True:
+                if module_m.ser.is_open:
+                    select.select([module_m.ser.fileno()], [], [], 1)
+                else:
+                    time.sleep(1)
+                module_m.read_frames()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            module_m.stop_capture()
@@ -0,0 +1,79 @@
+"""Connection state machine of the Module M link.
+
+    discovering -> opening -> registering -> streaming <-> stale
+         ^___________|____________|______________|
+
+ConnectionState tracks the current state and how long the link spent in each
+one, Backoff spaces out the port reopen and *A registration retries so a
+flapping USB link does not burn CPU or flood the log.
+"""
+import logging
+import random
+import time
+
+DISCOVERING = 'discovering' # waiting for the port to show up
+OPENING = 'opening' # port found, opening it
+REGISTERING = 'registering' # port open, waiting for *B after sending *A
+STREAMING = 'streaming' # registered and receiving frames
+STALE = 'stale' # registered, but no frames for a while
+STATES = (DISCOVERING, OPENING, REGISTERING, STREAMING, STALE)
+
+
+class Backoff:
+    """Capped exponential backoff with jitter, the first attempt after reset() is immediate"""
+
+    def __init__(self, initial: float, maximum: float, factor: float = 2.0, jitter: float = 0.2) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.reset()
+
+    def reset(self):
+        self.attempts = 0
+        self.next_attempt = 0.0
+
+    def ready(self) -> bool:
+        return time.monotonic() >= self.next_attempt
+
+    def failed(self) -> float:
+        """Schedule the next attempt, returns the delay until then"""
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        delay *= 1 - self.jitter * random.random()
+        self.attempts += 1
+        self.next_attempt = time.monotonic() + delay
+        return delay
+
+
+class ConnectionState:
+
+    def __init__(self) -> None:
+        self.state = DISCOVERING
+        self.port = None
+        self.since = time.monotonic()
+        self.durations = dict.fromkeys(STATES, 0.0) # seconds spent in each state, without the current stretch
+
+    def set(self, state: str, port: str = None) -> bool:
+        """Switch to state, returns True when the state changed"""
+        if port is not None:
+            self.port = port
+        if state == self.state:
+            return False
+        now = time.monotonic()
+        self.durations[self.state] += now - self.since
+        logging.info("Module M connection %s -> %s", self.state, state)
+        self.state = state
+        self.since = now
+        return True
+
+    def time_in_state(self) -> float:
+        return time.monotonic() - self.since
+
+    def totals(self) -> dict:
+        totals = dict(self.durations)
+        totals[self.state] += self.time_in_state()
+        return totals
+
+    def __str__(self) -> str:
+        totals = ", ".join(f"{state} {int(seconds)}s" for state, seconds in self.totals().items())
+        return f"{self.port or 'no port'} {self.state} for {int(self.time_in_state())}s ({totals})"
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
-import contextlib
+import argparse
 import logging
+import re
+import signal
 import time
 from gi.repository import GLib as gobject
 from dbus.mainloop.glib import DBusGMainLoop
@@ -9,159 +11,349 @@ import sys
 import os
 import _thread as thread
 from module_m_decoder import ModuleM
+from device_discovery import DeviceDiscovery, stop_serial_starter
+from connection_state import DISCOVERING, STREAMING
+from dbus_publisher import DbusPublisher, DeadbandTable
+from history import History, WINDOWS
+from energy_journal import EnergyJournal, JOURNAL_FILE
+from energy_integrator import EnergyIntegrator, COUNTERS
+from module_m_config import load_config, MeterRegistry, GRID_DEVICE_INSTANCE
+from module_m_logging import setup_logging, dump_ring_buffer
+from stats import Histogram, MetricsServer, AGE_BUCKETS
+from sample_mapping import METER_MAPPING, compile_mapping
+from profiling import Profiler, MemoryTracer
 
 # necessary packages from victron
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python')) # './ext/velib_python'
 from vedbus import VeDbusService
 
+_IMPORTED = time.monotonic() # for --startup-time
 VERSION = '2024.01'
+LOG_DUMP_FILE = '/data/module_m/dbus-homemanager.dump.log'
+
+# (path, initial value, unit of the text callback) of every meter, see DbusENERTYService._create_service
+METER_PATHS = [
+    ('/Mgmt/Connection', None, None),
+    ('/ProductId', 45058, None), # value used in ac_sensor_bridge.cpp of dbus-cgwacs
+    ('/HardwareVersion', 0, None),
+    ('/Connected', 1, None),
+    ('/Serial', "00000000000", None),
+    ('/ErrorCode', 0, None),
+]
+# the paths computed from the sample fields, see sample_mapping.py
+for _path, _unit in dict((spec.path, spec.unit) for spec in METER_MAPPING).items():
+    METER_PATHS.append((_path, 0, _unit))
+# integrated from the phase power, see energy_integrator.py
+for _phase in ('L1', 'L2', 'L3'):
+    METER_PATHS += [
+        (f'/Ac/{_phase}/Energy/Forward', 0, 'kWh'),
+        (f'/Ac/{_phase}/Energy/Reverse', 0, 'kWh'),
+    ]
+# rolling average / minimum / maximum of the total power, same unit as /Ac/Power
+METER_PATHS += [(f'/History/Power/{name}/{aggregate}', None, 'W')
+                for name, _ in WINDOWS for aggregate in ('Average', 'Minimum', 'Maximum')]
 
 
 class DbusENERTYService:
-    def __init__(self, servicename, deviceinstance, productname='ENERTY Module M reciever'):
-        self.module_m = ModuleM()
-
-        # Read data from Home Manager once to get the serial number and firmware version
-        # if not self.home_manager._read_data(timeout=10):
-        #     logging.error('Could not read data from Home Manager, aborting startup')
-        #     sys.exit(1)
-        # self.home_manager._decode_data()
-
-        self._dbusservice = VeDbusService("{}.http_{:02d}".format(servicename, deviceinstance))
-        logging.debug(f"{servicename} /DeviceInstance = {deviceinstance}")
-
-        # Register management objects, see dbus-api for more information
-        self._dbusservice.add_path('/Mgmt/ProcessName', productname)
-        self._dbusservice.add_path('/Mgmt/ProcessVersion', VERSION)
-        self._dbusservice.add_path('/Mgmt/Connection', None)
-
-        # Register mandatory objects
-        self._dbusservice.add_path('/DeviceInstance', deviceinstance)
-        self._dbusservice.add_path('/ProductId', 45058)  # value used in ac_sensor_bridge.cpp of dbus-cgwacs
-        self._dbusservice.add_path('/ProductName', productname)
-        # self._dbusservice.add_path('/FirmwareVersion', self.home_manager.hmdata['fw_version'])
-        self._dbusservice.add_path('/HardwareVersion', 0)
-        self._dbusservice.add_path('/Connected', 1)
-        self._dbusservice.add_path('/Serial', "00000000000")
-        self._dbusservice.add_path('/ErrorCode', 0)
-        self._dbusservice.add_path('/Ac/Power', 0, gettextcallback=self._get_text_for_w)
-        self._dbusservice.add_path('/Ac/L1/Voltage', 0, gettextcallback=self._get_text_for_v)
-        self._dbusservice.add_path('/Ac/L2/Voltage', 0, gettextcallback=self._get_text_for_v)
-        self._dbusservice.add_path('/Ac/L3/Voltage', 0, gettextcallback=self._get_text_for_v)
-        self._dbusservice.add_path('/Ac/L1/Current', 0, gettextcallback=self._get_text_for_a)
-        self._dbusservice.add_path('/Ac/L2/Current', 0, gettextcallback=self._get_text_for_a)
-        self._dbusservice.add_path('/Ac/L3/Current', 0, gettextcallback=self._get_text_for_a)
-        self._dbusservice.add_path('/Ac/L1/Power', 0, gettextcallback=self._get_text_for_w)
-        self._dbusservice.add_path('/Ac/L2/Power', 0, gettextcallback=self._get_text_for_w)
-        self._dbusservice.add_path('/Ac/L3/Power', 0, gettextcallback=self._get_text_for_w)
-
-        self._dbusservice.add_path('/Ac/L1/Energy/Forward', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L2/Energy/Forward', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L3/Energy/Forward', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L1/Energy/Reverse', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L2/Energy/Reverse', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/L3/Energy/Reverse', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/Energy/Forward', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/Energy/Reverse', 0, gettextcallback=self._get_text_for_kwh)
-        self._dbusservice.add_path('/Ac/Current', 0, gettextcallback=self._get_text_for_a)
-
-        gobject.timeout_add(300, self._update)
+    def __init__(self, servicename, deviceinstance, productname='ENERTY Module M reciever', config=None, port=None,
+                 module_m=None, journal_path=None, position=None):
+        # MeterManager passes a registered ModuleM, a single meter service finds and opens the port itself
+        self.module_m = module_m if module_m is not None else ModuleM(port=port)
+        self.config = config if config is not None else load_config()
+
+        # the energy counters survive a restart, they are published before the first *D frame arrives
+        if journal_path is None:
+            journal_path = self.config.get('journal', 'path', fallback=JOURNAL_FILE)
+        self.journal = EnergyJournal(journal_path, counters=COUNTERS,
+                                     interval=self.config.getfloat('journal', 'interval', fallback=300),
+                                     delta=self.config.getfloat('journal', 'delta', fallback=100))
+        energy = self.journal.replay()
+        if 'energy_forward' in energy and 'energy_reverse' in energy:
+            self.module_m.mmdata = self.module_m.mmdata._replace(energy_forward=int(energy['energy_forward']),
+                                                                 energy_reverse=int(energy['energy_reverse']))
+        # per-phase energy from the phase power, split by the device totals
+        self.energy = EnergyIntegrator(max_gap=self.config.getfloat('energy', 'max_gap', fallback=5))
+        self.energy.restore(energy)
+        self.module_m.sample_listeners.append(self._integrate_energy)
+
+        # optional re-broadcast of every frame as an SMA Speedwire energy meter datagram
+        self.speedwire = None
+        if self.config.getboolean('speedwire', 'enabled', fallback=False):
+            from speedwire import SpeedwireBroadcaster, MULTICAST_GROUP, PORT as SPEEDWIRE_PORT # most sites do without
+            self.speedwire = SpeedwireBroadcaster(group=self.config.get('speedwire', 'group', fallback=MULTICAST_GROUP),
+                                                  port=self.config.getint('speedwire', 'port', fallback=SPEEDWIRE_PORT),
+                                                  interface=self.config.get('speedwire', 'interface', fallback='0.0.0.0'),
+                                                  ttl=self.config.getint('speedwire', 'ttl', fallback=1),
+                                                  loop=self.config.getboolean('speedwire', 'loop', fallback=False))
+            self.module_m.sample_listeners.append(self._broadcast)
+
+        # rolling average / minimum / maximum of the total power, fed with every decoded frame
+        self.history = History(capacity=self.config.getint('history', 'capacity', fallback=4096))
+        self.module_m.sample_listeners.append(self.history.add)
+
+        # sample -> path values, generated from the declarative mapping once
+        self._mapping = compile_mapping(METER_MAPPING)
+
+        # runtime statistics next to the decoder counters, published every watchdog tick, see stats.py
+        self.publish_latency = Histogram() # seconds from the arrival of a sample to its D-Bus publish
+        self.sample_age = Histogram(AGE_BUCKETS) # age of the newest sample at every watchdog tick
+        self.loop_jitter = Histogram() # how far the watchdog tick is off its 1 s schedule
+        self._published_timestamp = None
+        self._last_tick = None
+
+        # every path is added before the service name is claimed, see _create_service
+        paths = [
+            ('/Mgmt/ProcessName', productname, None),
+            ('/Mgmt/ProcessVersion', VERSION, None),
+            ('/DeviceInstance', deviceinstance, None),
+            ('/ProductName', productname, None),
+        ]
+        if position is not None:
+            paths.append(('/Position', position, None)) # pvinverter
+        paths += METER_PATHS
+        paths += [(path, None, None) for path in self._stats_values()]
+        self._dbusservice = self._create_service("{}.http_{:02d}".format(servicename, deviceinstance), paths)
+        logging.debug("%s /DeviceInstance = %s", servicename, deviceinstance)
+
+        # all writes go through the publisher, it skips unchanged and insignificant values and batches the rest into one ItemsChanged
+        self._publisher = DbusPublisher(self._dbusservice, DeadbandTable.from_config(self.config))
 
+        self._serial_watch = None
+        self._serial_fd = None
         self.last_error_switch = time.time()
+        if energy:
+            self._publish()
+        try:
+            self._claim_name()
+        except Exception: # e.g. NameExists, nothing of this service may keep running
+            self.close()
+            raise
+
+        # the GLib sources are only added once the name is ours. serial data is handled as soon as
+        # it arrives, the timer only drives the stale data watchdog, the error rotation and port
+        # discovery / registration
+        gobject.timeout_add(1000, self._watchdog)
+        # a plugged in Module M is opened right away instead of on the next watchdog tick
+        if self.module_m.reconnect and self.module_m.discovery.fileno() is not None:
+            gobject.io_add_watch(self.module_m.discovery.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN, self._on_device_change)
+
+    def _create_service(self, name: str, paths):
+        """VeDbusService with the (path, value, unit) paths, the name is only claimed by _claim_name().
+
+        D-Bus clients like systemcalc react to the name, so they find a complete service
+        with the journal energy instead of the paths showing up one by one.
+        """
+        try:
+            service = VeDbusService(name, register=False)
+            self._register = getattr(service, 'register', None)
+        except TypeError: # velib_python before register=False claims the name right away
+            service = VeDbusService(name)
+            self._register = None
+        texts = {'W': self._get_text_for_w, 'V': self._get_text_for_v, 'A': self._get_text_for_a,
+                 'kWh': self._get_text_for_kwh}
+        for path, value, unit in paths:
+            if unit is None:
+                service.add_path(path, value)
+            else:
+                service.add_path(path, value, gettextcallback=texts[unit])
+        return service
+
+    def _claim_name(self):
+        if self._register is not None:
+            self._register()
+            self._register = None
+
+    def close(self):
+        """Write the energy counters that are not in the journal yet"""
+        self.journal.flush()
+        self.journal.close()
+        self.module_m.stop_capture()
+        if self.speedwire is not None:
+            self.speedwire.close()
+
+    def attach(self, module_m):
+        """Continue with a newly opened ModuleM of the same meter, e.g. after it was plugged into another port"""
+        old = self.module_m
+        old.ser.close()
+        module_m.sample_listeners = old.sample_listeners
+        if module_m.mmdata.command != ord('D'): # keep the energy until the new port sends it
+            module_m.mmdata = module_m.mmdata._replace(energy_forward=old.mmdata.energy_forward,
+                                                       energy_reverse=old.mmdata.energy_reverse)
+        if module_m.capture is None:
+            module_m.capture, old.capture = old.capture, None
+        else:
+            old.stop_capture()
+        module_m.reconnect = False
+        self.module_m = module_m
+        logging.info("Meter %s continues on %s", module_m.serialnumber, module_m.port)
+        self._publish_connection()
+        self._watch_serial_port()
 
-        self.timeout_errorcode_timer = 0
+    def _broadcast(self, sample):
+        if self.speedwire.serial is None and self.module_m.serialnumber is not None:
+            from speedwire import speedwire_serial
+            self.speedwire.serial = speedwire_serial(self.module_m.serialnumber)
+        self.speedwire.send(sample, self.energy.phase_energy())
 
-    def _update(self):
+    def _integrate_energy(self, sample):
+        self.energy.add(sample)
+        if sample.command == ord('D'): # the counters only move for good with the device totals
+            self.journal.update(self.energy.state())
 
+    def _watch_serial_port(self):
+        """(Re)attach the GLib io watch when Module M was (re)opened on a new file descriptor"""
+        fd = self.module_m.ser.fileno() if self.module_m.ser.is_open else None
+        if fd == self._serial_fd:
+            return
+        if self._serial_watch is not None:
+            gobject.source_remove(self._serial_watch)
+            self._serial_watch = None
+        self._serial_fd = fd
+        if fd is not None:
+            self._serial_watch = gobject.io_add_watch(fd, gobject.PRIORITY_DEFAULT,
+                                                      gobject.IO_IN | gobject.IO_ERR | gobject.IO_HUP, self._on_serial_data)
+
+    def _on_serial_data(self, fd, condition):
+        if condition & (gobject.IO_ERR | gobject.IO_HUP):
+            logging.error('Module M serial port hung up')
+            self.module_m.ser.close() # the watchdog rediscovers the port
+            self._serial_watch = None
+            self._serial_fd = None
+            return False
+        if self.module_m.read_frames():
+            self._publish()
+        self._watch_serial_port()
+        return True # Return True to keep watching
+
+    def _on_device_change(self, fd, condition):
+        if self.module_m.discovery.poll() and not self.module_m.ser.is_open:
+            self.module_m.read_frames()
+            self._publish_connection()
+            self._watch_serial_port()
+        return True # Return True to keep watching
+
+    def _watchdog(self):
+        now = time.monotonic()
+        if self._last_tick is not None:
+            self.loop_jitter.observe(abs(now - self._last_tick - 1))
+        self._last_tick = now
+        if self.module_m.mmdata.timestamp:
+            self.sample_age.observe(now - self.module_m.mmdata.timestamp)
+
+        # everything of this tick goes out in one publish() call, one ItemsChanged
+        values = {}
         # Check for errors every 10 seconds
         if time.time() - self.last_error_switch > 10:
             self.last_error_switch = time.time()
             if len(self.module_m.errors) == 0:
-                self._dbusservice['/ErrorCode'] = 0
+                values['/ErrorCode'] = 0
             else:
                 if self.module_m.errors_show_index > len(self.module_m.errors) - 1:
                     self.module_m.errors_show_index = 0
-                self._dbusservice['/ErrorCode'] = self.module_m.errors[self.module_m.errors_show_index]
+                values['/ErrorCode'] = self.module_m.errors[self.module_m.errors_show_index]
                 self.module_m.errors_show_index += 1
 
-        if self.module_m._read_data() and self.module_m._decode_data():
-            pass
+        # finds and opens the port when it is missing and retries the *A registration
+        new_sample = self.module_m.read_frames() > 0
+        if not new_sample and time.time() - self.module_m.last_update > 2:
+            logging.error('No data received from Module M for 2 seconds, setting all values to zero')
+            values['/ErrorCode'] = f"No data received from Module M for { int(time.time() - self.module_m.last_update) } seconds" # overwrite the error code
+            self.module_m.mmdata = self.module_m.mmdata.zeroed()
+            new_sample = True
+        values.update(self._connection_values())
+        values.update(self._stats_values())
+        if new_sample:
+            self._publish(values)
         else:
-            if time.time() - self.module_m.last_update > 2 and time.time() - self.timeout_errorcode_timer > 1:
-                logging.error('No data received from Module M for 2 seconds, setting all values to zero')
-                self._dbusservice['/ErrorCode'] = f"No data received from Module M for { int(time.time() - self.module_m.last_update) } seconds" # overwrite the error code
-                self.module_m.mmdata.set_all_to_zero()
-                self.timeout_errorcode_timer = time.time() # prevents dbus messages every 300ms
-        
-        # settings or errors from the module_m object
-        if self.module_m.new_port_name:
-            self._dbusservice['/Mgmt/Connection'] = self.module_m.ser.portstr
-            self.module_m.new_port_name = False
-        if self.module_m.new_serialnumber:
-            try:
-                self._dbusservice['/Serial'] = self.module_m.serialnumber.decode('utf-8')
-            except Exception as e:
-                logging.error(f"Error setting serial number: {e}")
-            self.module_m.new_serialnumber = False
-
-
-        with contextlib.suppress(KeyError):
-            # Check if the Home Manager is single phase or three phase
-            if self.module_m.mmdata.I2 == 0 and self.module_m.mmdata.I3 == 0 and self.module_m.mmdata.U2 == 0 and self.module_m.mmdata.U3 == 0:
-                single_phase = True
-            else:
-                single_phase = False
-            
-            # Calculate the total current
-            if single_phase:
-                current = round(self.module_m.mmdata.I1 / 1000, 3)
-            else:
-                current = round((self.module_m.mmdata.I1 + self.module_m.mmdata.I2 +
-                                self.module_m.mmdata.I3) / 1000, 3)
-                
-            self._dbusservice['/Ac/Current'] = current
-
-            P1 = -self.module_m.mmdata.P1 if self.module_m.mmdata.export_CT1 else self.module_m.mmdata.P1 # W
-            P2 = -self.module_m.mmdata.P2 if self.module_m.mmdata.export_CT2 else self.module_m.mmdata.P2 # W
-            P3 = -self.module_m.mmdata.P3 if self.module_m.mmdata.export_CT3 else self.module_m.mmdata.P3 # W
-
-            self._dbusservice['/Ac/Power'] = (P1 + P2 + P3) / 1000  #kw
-            
-            self._dbusservice['/Ac/Energy/Forward'] = self.module_m.mmdata.energy_forward / 1000  #kWh
-            self._dbusservice['/Ac/Energy/Reverse'] = self.module_m.mmdata.energy_reverse / 1000
-
-            self._dbusservice['/Ac/L1/Voltage'] = self.module_m.mmdata.U1 / 1000
-            self._dbusservice['/Ac/L2/Voltage'] = self.module_m.mmdata.U2 / 1000
-            self._dbusservice['/Ac/L3/Voltage'] = self.module_m.mmdata.U3 / 1000
-            self._dbusservice['/Ac/L1/Current'] = self.module_m.mmdata.I1 / 1000
-            self._dbusservice['/Ac/L2/Current'] = self.module_m.mmdata.I2 / 1000
-            self._dbusservice['/Ac/L3/Current'] = self.module_m.mmdata.I3 / 1000
-
-            self._dbusservice['/Ac/L1/Power'] = P1 / 1000
-            self._dbusservice['/Ac/L2/Power'] = P2 / 1000
-            self._dbusservice['/Ac/L3/Power'] = P3 / 1000
-            
-            # return here if all values are set to zero. This way the AC totals are not updated and still visible in the dbus
-            if self.module_m.mmdata.I1 == 0 and self.module_m.mmdata.U1 == 0:
-                return True
-            if single_phase:
-                self._dbusservice['/Ac/L1/Energy/Forward'] = self.module_m.mmdata.energy_forward / 1000
-                self._dbusservice['/Ac/L2/Energy/Forward'] = 0
-                self._dbusservice['/Ac/L3/Energy/Forward'] = 0
-                self._dbusservice['/Ac/L1/Energy/Reverse'] = self.module_m.mmdata.energy_reverse / 1000
-                self._dbusservice['/Ac/L2/Energy/Reverse'] = 0
-                self._dbusservice['/Ac/L3/Energy/Reverse'] = 0
-            else:
-                self._dbusservice['/Ac/L1/Energy/Forward'] = round(self.module_m.mmdata.energy_forward / 3000, 3)
-                self._dbusservice['/Ac/L2/Energy/Forward'] = round(self.module_m.mmdata.energy_forward / 3000, 3)
-                self._dbusservice['/Ac/L3/Energy/Forward'] = round(self.module_m.mmdata.energy_forward / 3000, 3)
-                self._dbusservice['/Ac/L1/Energy/Reverse'] = round(self.module_m.mmdata.energy_reverse / 3000, 3)
-                self._dbusservice['/Ac/L2/Energy/Reverse'] = round(self.module_m.mmdata.energy_reverse / 3000, 3)
-                self._dbusservice['/Ac/L3/Energy/Reverse'] = round(self.module_m.mmdata.energy_reverse / 3000, 3)
+            values.update(self._history_values()) # the windows also move on without new frames
+            self._publisher.publish(values)
+        self._watch_serial_port()
         return True # Return True to keep looping
 
+    def _connection_values(self) -> dict:
+        values = {'/Mgmt/Connection': str(self.module_m.connection)}
+        if self.module_m.serialnumber is not None:
+            values['/Serial'] = self.module_m.serialnumber.decode('utf-8', errors='replace')
+        return values
+
+    def _publish_connection(self):
+        # the publisher only sends what changed
+        self._publisher.publish(self._connection_values())
+
+    def _publish(self, extra: dict = None):
+        """Publish the current sample with its history aggregates and the extra values as one batch"""
+        mmdata = self.module_m.mmdata
+        values = self._mapping(mmdata) # single phase meters only sum L1 into /Ac/Current, see METER_MAPPING
+
+        # skip the phase energy if all values are set to zero. This way the AC totals are not updated and still visible in the dbus
+        if mmdata.I1 != 0 or mmdata.U1 != 0:
+            for phase, (forward, reverse) in zip(('L1', 'L2', 'L3'), self.energy.phase_energy()):
+                values[f'/Ac/{phase}/Energy/Forward'] = round(forward / 1000, 3)
+                values[f'/Ac/{phase}/Energy/Reverse'] = round(reverse / 1000, 3)
+
+        values.update(self._history_values())
+        if extra:
+            values.update(extra)
+        self._publisher.publish(values)
+        if mmdata.timestamp and mmdata.timestamp != self._published_timestamp: # not for a replayed or zeroed sample
+            self._published_timestamp = mmdata.timestamp
+            self.publish_latency.observe(time.monotonic() - mmdata.timestamp)
+
+    def _history_values(self) -> dict:
+        values = {}
+        for (_, name), aggregate in self.history.aggregates(time.monotonic()).items():
+            average, minimum, maximum = aggregate if aggregate is not None else (None, None, None)
+            # same unit as /Ac/Power
+            values[f'/History/Power/{name}/Average'] = round(average / 1000, 3) if average is not None else None
+            values[f'/History/Power/{name}/Minimum'] = minimum / 1000 if minimum is not None else None
+            values[f'/History/Power/{name}/Maximum'] = maximum / 1000 if maximum is not None else None
+        return values
+
+    def _stats_values(self) -> dict:
+        module_m = self.module_m
+        timestamp = module_m.mmdata.timestamp
+        return {
+            '/Mgmt/Stats/FramesDecoded': module_m.frames_decoded,
+            '/Mgmt/Stats/FramesCoalesced': module_m.frames_coalesced,
+            '/Mgmt/Stats/FramesSkipped': module_m.frames_skipped,
+            '/Mgmt/Stats/BytesReceived': module_m.bytes_received,
+            '/Mgmt/Stats/BytesDiscarded': module_m.bytes_discarded,
+            '/Mgmt/Stats/ShortReads': module_m.short_reads,
+            '/Mgmt/Stats/RegistrationRequests': module_m.registration_requests,
+            '/Mgmt/Stats/PortOpens': module_m.port_opens,
+            '/Mgmt/Stats/Latency/Decode/P50': _milliseconds(module_m.decode_latency.quantile(0.5)),
+            '/Mgmt/Stats/Latency/Decode/P99': _milliseconds(module_m.decode_latency.quantile(0.99)),
+            '/Mgmt/Stats/Latency/Publish/P50': _milliseconds(self.publish_latency.quantile(0.5)),
+            '/Mgmt/Stats/Latency/Publish/P99': _milliseconds(self.publish_latency.quantile(0.99)),
+            '/Mgmt/Stats/LoopJitter/P99': _milliseconds(self.loop_jitter.quantile(0.99)),
+            '/Mgmt/Stats/SampleAge': round(time.monotonic() - timestamp, 1) if timestamp else None, # seconds
+        }
+
+    def metrics(self) -> list:
+        """(name, help, labels, value) of this meter for stats.format_prometheus"""
+        module_m = self.module_m
+        serial = module_m.serialnumber.decode('utf-8', errors='replace').strip('\x00 ') if module_m.serialnumber else ''
+        labels = {'serial': serial}
+        timestamp = module_m.mmdata.timestamp
+        return [
+            ('module_m_streaming', '1 while the meter sends frames', labels, int(module_m.connection.state == STREAMING)),
+            ('module_m_frames_decoded_total', 'Measurement frames decoded', labels, module_m.frames_decoded),
+            ('module_m_frames_coalesced_total', 'Decoded frames replaced by a newer one before publishing', labels, module_m.frames_coalesced),
+            ('module_m_frames_skipped_total', 'Unknown, unregistered or overflowed frames', labels, module_m.frames_skipped),
+            ('module_m_bytes_received_total', 'Bytes read from the serial port', labels, module_m.bytes_received),
+            ('module_m_bytes_discarded_total', 'Garbage bytes dropped while searching for a frame start', labels, module_m.bytes_discarded),
+            ('module_m_short_reads_total', 'Decode attempts that waited for the rest of a frame', labels, module_m.short_reads),
+            ('module_m_registration_requests_total', 'Registration requests (*A) sent', labels, module_m.registration_requests),
+            ('module_m_port_opens_total', 'Attempts to open the serial port', labels, module_m.port_opens),
+            ('module_m_sample_age_seconds', 'Age of the newest sample', labels, round(time.monotonic() - timestamp, 3) if timestamp else None),
+            ('module_m_decode_latency_seconds', 'Serial arrival to decode', labels, module_m.decode_latency),
+            ('module_m_publish_latency_seconds', 'Decode to D-Bus publish', labels, self.publish_latency),
+            ('module_m_watchdog_sample_age_seconds', 'Age of the newest sample at every watchdog tick', labels, self.sample_age),
+            ('module_m_loop_jitter_seconds', 'Deviation of the watchdog tick from its 1 s schedule', labels, self.loop_jitter),
+        ]
+
     def _handle_changed_value(self, value):
-        logging.debug(f"Object {self} has been changed to {value}")
+        logging.debug("Object %s has been changed to %s", self, value)
         return True # Return True to keep looping
 
     def _get_text_for_kwh(self, path, value):
@@ -177,11 +369,221 @@ class DbusENERTYService:
         return "%.1FA" % (float(value))
 
 
+def _milliseconds(seconds):
+    """Histogram quantile for D-Bus, None without observations or above the last bucket"""
+    if seconds is None or seconds == float('inf'):
+        return None
+    return round(seconds * 1000, 1)
+
+
+class MeterManager:
+    """One process for every Module M: discovers the ports, waits for the serial number
+    each meter sends in *B and runs a DbusENERTYService per serial number.
+
+    All meters share the GLib main loop. The ports are only opened here, a meter that
+    was unplugged is opened again as a new port and handed to its service by serial number.
+    """
+
+    def __init__(self, config=None, capture: str = None) -> None:
+        self.config = config if config is not None else load_config()
+        self.registry = MeterRegistry(self.config)
+        self.discovery = DeviceDiscovery()
+        self.capture = capture
+        self.pending = {} # port -> ModuleM waiting for *B
+        self.services = {} # serial number -> DbusENERTYService
+        gobject.timeout_add(1000, self._scan)
+        if self.discovery.fileno() is not None:
+            gobject.io_add_watch(self.discovery.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN, self._on_device_change)
+        self._scan()
+
+    def close(self):
+        for service in self.services.values():
+            service.close()
+        for module_m in self.pending.values():
+            module_m.stop_capture()
+
+    def metrics(self) -> list:
+        return [metric for service in self.services.values() for metric in service.metrics()]
+
+    def _on_device_change(self, fd, condition):
+        if self.discovery.poll():
+            self._scan()
+        return True # Return True to keep watching
+
+    def _ports_in_use(self) -> set:
+        ports = set(self.pending)
+        ports.update(service.module_m.port for service in self.services.values() if service.module_m.ser.is_open)
+        return ports
+
+    def _scan(self):
+        try:
+            self._scan_ports()
+        except Exception: # an exception would remove the GLib timeout, discovery must go on
+            logging.exception("Scanning the Module M ports failed")
+        return True # Return True to keep looping
+
+    def _scan_ports(self):
+        in_use = self._ports_in_use()
+        for port in self.discovery.find_all():
+            if port.device in in_use:
+                continue
+            stop_serial_starter(port.name)
+            module_m = ModuleM(port=port.device, discovery=self.discovery)
+            if self.capture:
+                root, ext = os.path.splitext(self.capture)
+                module_m.start_capture(f"{root}-{port.name}{ext}")
+            self.pending[port.device] = module_m
+        for device, module_m in list(self.pending.items()):
+            module_m.read_frames() # opens the port, sends *A and decodes *B
+            if module_m.serialnumber is not None:
+                del self.pending[device]
+                try:
+                    self._attach(module_m)
+                except Exception:
+                    # the port is closed, the next scan opens and registers it again
+                    logging.exception("Could not start the service of the Module M on %s", device)
+                    module_m.stop_capture()
+                    module_m.ser.close()
+            elif module_m.connection.state == DISCOVERING and not os.path.exists(device):
+                module_m.stop_capture()
+                del self.pending[device]
+
+    def _attach(self, module_m):
+        serial = module_m.serialnumber.decode('utf-8', errors='replace').strip('\x00 ')
+        service = self.services.get(serial)
+        if service is not None:
+            service.attach(module_m)
+            return
+        module_m.reconnect = False
+        settings = self.registry.lookup(serial)
+        name = re.sub(r'[^A-Za-z0-9_]', '_', serial)
+        self.services[serial] = DbusENERTYService(
+            servicename=f"com.victronenergy.{settings['role']}.module_m_{name}",
+            deviceinstance=settings['deviceinstance'],
+            config=self.config,
+            module_m=module_m,
+            journal_path=self._journal_path(name, settings['deviceinstance']),
+            position=settings['position'] if settings['role'] == 'pvinverter' else None)
+
+    def _journal_path(self, name: str, deviceinstance: int) -> str:
+        """A journal per meter, the grid meter takes over the journal of the single meter service"""
+        legacy = self.config.get('journal', 'path', fallback=JOURNAL_FILE)
+        root, ext = os.path.splitext(legacy)
+        path = f"{root}-{name}{ext}"
+        if deviceinstance == GRID_DEVICE_INSTANCE and not os.path.exists(path) and os.path.exists(legacy):
+            os.replace(legacy, path)
+        return path
+
+
+def _dump_log(*args):
+    dump_ring_buffer(LOG_DUMP_FILE)
+    return True # keep the signal handler installed
+
+
+def _process_age():
+    """Seconds since the process was started (10 ms resolution), None without /proc"""
+    try:
+        with open('/proc/self/stat') as file:
+            started = int(file.read().rsplit(')', 1)[1].split()[19]) # field 22, starttime in clock ticks after boot
+        with open('/proc/uptime') as file:
+            uptime = float(file.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - started / os.sysconf('SC_CLK_TCK')
+
+
+class StartupTimer:
+    """Cold start milestones for --startup-time, in seconds since the process was started.
+
+    The interpreter start is taken from /proc, the milestones after it from time.monotonic().
+    The result is logged and appended to path as a JSON line, so releases can be compared.
+    """
+
+    def __init__(self, path: str = None, timeout: float = 60) -> None:
+        self.path = path
+        self.timeout = timeout
+        age = _process_age()
+        self.started = time.monotonic() - age if age is not None else _IMPORTED
+        self.milestones = {'imports': round(_IMPORTED - self.started, 3)}
+
+    def mark(self, name: str):
+        if name not in self.milestones:
+            self.milestones[name] = round(time.monotonic() - self.started, 3)
+
+    def watch(self, service, mainloop, metrics_server=None):
+        """Mark the first claimed D-Bus name and the first published sample, then stop the service"""
+        def poll():
+            services = list(service.services.values()) if isinstance(service, MeterManager) else [service]
+            if services:
+                self.mark('service')
+            if any(meter.module_m.frames_decoded for meter in services):
+                self.mark('first sample')
+            elif time.monotonic() - self.started < self.timeout:
+                return True
+            self.report()
+            return _stop(service, mainloop, metrics_server)
+        gobject.timeout_add(10, poll)
+
+    def report(self):
+        logging.info('Startup time: %s', ', '.join(f'{name} {seconds:.3f} s' for name, seconds in self.milestones.items()))
+        if 'first sample' not in self.milestones:
+            logging.error('No sample published within %d seconds', self.timeout)
+        if self.path:
+            import json
+            with open(self.path, 'a') as file:
+                file.write(json.dumps({'version': VERSION, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                       'milestones': self.milestones}) + '\n')
+
+
+def _stop(service, mainloop, metrics_server=None):
+    logging.info('Stopping')
+    service.close()
+    if metrics_server is not None:
+        metrics_server.close()
+    mainloop.quit()
+    return False
+
+
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='ENERTY Module M grid meter service')
+    parser.add_argument('--log-file', help='log to this file (rotated) instead of stderr')
+    parser.add_argument('--log-level', default='INFO', help='DEBUG, INFO, WARNING or ERROR')
+    parser.add_argument('--port', help='serial port to use instead of finding Module M by its USB id, e.g. the emulator pty')
+    parser.add_argument('--capture', help='record the raw serial data to this file (one per port), replay it with capture.py')
+    parser.add_argument('--startup-time', nargs='?', const='', metavar='FILE',
+                        help='measure the time until the first sample is published, append it to FILE as JSON and exit')
+    args = parser.parse_args()
+    setup_logging(args.log_level.upper(), args.log_file)
+    # svc -h /service/venus-homemanager writes the last log lines kept in memory to LOG_DUMP_FILE
+    gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGHUP, _dump_log)
+    # SIGUSR1 toggles a cProfile capture, SIGUSR2 a tracemalloc difference, both written to /data/module_m/
+    gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGUSR1, Profiler().toggle)
+    gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGUSR2, MemoryTracer().snapshot)
     thread.daemon = True
     DBusGMainLoop(set_as_default=True)
-    DbusENERTYService(servicename='com.victronenergy.grid.tcpip_239_12_255_254', deviceinstance=40)
+    config = load_config()
+    if args.port:
+        # a single meter on a fixed port
+        service = DbusENERTYService(servicename='com.victronenergy.grid.tcpip_239_12_255_254', deviceinstance=40,
+                                    config=config, port=args.port)
+        if args.capture:
+            service.module_m.start_capture(args.capture)
+    else:
+        service = MeterManager(config=config, capture=args.capture)
+    # optional Prometheus text of the runtime statistics on a Unix socket
+    metrics_server = None
+    if config.get('stats', 'socket', fallback=''):
+        try:
+            metrics_server = MetricsServer(config.get('stats', 'socket'), service.metrics)
+            gobject.io_add_watch(metrics_server.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN,
+                                 lambda fd, condition: metrics_server.handle())
+        except OSError as e:
+            logging.error("Could not open the metrics socket %s: %s", config.get('stats', 'socket'), e)
+            metrics_server = None
     logging.info('Connected to dbus, switching over to gobject.MainLoop()')
     mainloop = gobject.MainLoop()
+    if args.startup_time is not None:
+        StartupTimer(args.startup_time).watch(service, mainloop, metrics_server)
+    # svc -d and kill_me.sh send SIGTERM, the energy journal is flushed before exiting
+    gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGTERM, _stop, service, mainloop, metrics_server)
     mainloop.run()
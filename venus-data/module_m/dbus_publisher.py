@@ -0,0 +1,130 @@
+"""Change-only publishing of values on a VeDbusService.
+
+Every D-Bus write of a changed value emits a signal that systemcalc, hub4control
+and the GUI all wake up for. DbusPublisher remembers what was published last,
+skips the paths that did not change and writes the rest inside one
+`with service as s:` block, which velib_python sends as a single ItemsChanged
+signal. Older velib versions without the context manager get plain writes.
+
+A DeadbandTable can additionally hold back insignificant changes per path, like
+a few mV of voltage jitter, until they grow or the path was silent for too long.
+"""
+import fnmatch
+import time
+
+
+class Deadband:
+    """Holds back changes within max(absolute, relative * |last published|), at most heartbeat seconds"""
+
+    def __init__(self, absolute: float = 0.0, relative: float = 0.0, heartbeat: float = 0.0) -> None:
+        self.absolute = absolute
+        self.relative = relative
+        self.heartbeat = heartbeat # 0 holds back forever, a changed value still goes out once it grows
+
+    def suppresses(self, published, value, silent_for: float) -> bool:
+        if self.heartbeat and silent_for >= self.heartbeat:
+            return False
+        try:
+            delta = abs(value - published)
+            band = max(self.absolute, self.relative * abs(published))
+        except TypeError: # strings, None, ...
+            return False
+        return delta <= band
+
+
+# /Ac/Power feeds the ESS regulation, it is never held back
+DEFAULT_DEADBANDS = (
+    ('/Ac/Power', Deadband()),
+    ('/Ac/L?/Voltage', Deadband(absolute=0.1, heartbeat=10)), # V
+    ('/Ac/*Current', Deadband(absolute=0.01, heartbeat=10)), # A
+    ('/Ac/L?/Power', Deadband(absolute=1, heartbeat=5)), # W
+)
+
+
+class DeadbandTable:
+    """Deadbands per path or fnmatch path pattern, the first matching rule wins"""
+
+    def __init__(self, rules=DEFAULT_DEADBANDS) -> None:
+        self.rules = list(rules)
+        self._cache = {}
+
+    @classmethod
+    def from_config(cls, config, defaults=DEFAULT_DEADBANDS):
+        """Rules from [deadband <path pattern>] sections with absolute, relative and heartbeat options,
+        they take precedence over the defaults"""
+        rules = []
+        for section in config.sections():
+            kind, _, pattern = section.partition(' ')
+            if kind != 'deadband' or not pattern:
+                continue
+            options = config[section]
+            rules.append((pattern.strip(), Deadband(absolute=options.getfloat('absolute', 0.0),
+                                                    relative=options.getfloat('relative', 0.0),
+                                                    heartbeat=options.getfloat('heartbeat', 0.0))))
+        return cls(rules + list(defaults))
+
+    def lookup(self, path):
+        try:
+            return self._cache[path]
+        except KeyError:
+            pass
+        deadband = None
+        for pattern, rule in self.rules:
+            if fnmatch.fnmatchcase(path, pattern):
+                deadband = rule
+                break
+        self._cache[path] = deadband
+        return deadband
+
+
+class DbusPublisher:
+
+    def __init__(self, service, deadbands: DeadbandTable = None) -> None:
+        self._service = service
+        self._deadbands = deadbands
+        self._published = {}
+        self._published_at = {}
+        self._batched = hasattr(service, '__enter__') and hasattr(service, '__exit__')
+
+    def __getitem__(self, path):
+        return self._published[path]
+
+    def __setitem__(self, path, value):
+        self.publish({path: value})
+
+    def publish(self, values: dict) -> int:
+        """Write the paths of values that differ significantly from the last published value, returns the amount written"""
+        published = self._published
+        if self._deadbands is None:
+            changed = {path: value for path, value in values.items()
+                       if path not in published or published[path] != value}
+        else:
+            changed = {}
+            now = time.monotonic()
+            for path, value in values.items():
+                if path in published:
+                    if published[path] == value:
+                        continue
+                    deadband = self._deadbands.lookup(path)
+                    if deadband is not None and deadband.suppresses(published[path], value, now - self._published_at[path]):
+                        continue
+                changed[path] = value
+                self._published_at[path] = now
+        if not changed:
+            return 0
+        if self._batched:
+            with self._service as service:
+                for path, value in changed.items():
+                    service[path] = value
+        else:
+            for path, value in changed.items():
+                self._service[path] = value
+        published.update(changed)
+        return len(changed)
+
+    def forget(self, path=None):
+        """Publish path (or every path) again on the next write, e.g. after it was changed through D-Bus"""
+        if path is None:
+            self._published.clear()
+        else:
+            self._published.pop(path, None)
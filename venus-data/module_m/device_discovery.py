@@ -0,0 +1,128 @@
+"""Finding the Module M USB serial port.
+
+DeviceDiscovery watches /dev with inotify and only walks the serial ports again
+after a tty appeared or disappeared, so an unplugged Module M costs a single
+non blocking read per check instead of a full sysfs walk. The inotify file
+descriptor can be added to the main loop to react to a plug-in right away.
+Where inotify is not available it falls back to rescanning every few seconds.
+"""
+import ctypes
+import logging
+import os
+import struct
+import sys
+import time
+
+VID = 0x239A
+PID = 0x80A4
+
+IN_ATTRIB = 0x00000004 # udev fixes the permissions after the node is created
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_EVENT = struct.Struct("=iIII") # wd, mask, cookie, len, followed by the name
+
+
+def find_ports(vid: int = VID, pid: int = PID) -> list:
+    """The ListPortInfo of every port matching vid/pid, sorted by device name"""
+    import serial.tools.list_ports # imported on the first scan, it is not needed to start the service
+    ports = [port for port in serial.tools.list_ports.comports() if port.vid == vid and port.pid == pid]
+    return sorted(ports, key=lambda port: port.device)
+
+
+def find_port(vid: int = VID, pid: int = PID):
+    """Returns the ListPortInfo of the first port matching vid/pid, or None"""
+    ports = find_ports(vid, pid)
+    return ports[0] if ports else None
+
+
+def stop_serial_starter(tty_name: str):
+    """Tell the Venus OS serial starter to leave the tty alone"""
+    import subprocess # only needed once a port is found
+    try:
+        subprocess.run(["/opt/victronenergy/serial-starter/stop-tty.sh", tty_name])
+    except subprocess.CalledProcessError as e:
+        # Handle cases where the command fails
+        logging.warning("stop serial starter command CalledProcessError with return code: %s", e.returncode)
+    except FileNotFoundError:
+        # Handle case where the script is not found
+        logging.warning("The stop serial starter command or script does not exist. Please check the path.")
+
+
+def _inotify_watch(directory: str):
+    """Non blocking inotify fd watching directory for created / removed nodes, None when unsupported"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        # the symbols already loaded into the process include libc, ctypes.util.find_library would run ldconfig
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, directory.encode(), IN_CREATE | IN_DELETE | IN_ATTRIB) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class DeviceDiscovery:
+
+    def __init__(self, vid: int = VID, pid: int = PID, directory: str = '/dev', fallback_interval: float = 5.0) -> None:
+        self.vid = vid
+        self.pid = pid
+        self.fallback_interval = fallback_interval
+        self._fd = _inotify_watch(directory)
+        self._dirty = True # scan once at startup
+        self._last_scan = 0.0
+        self._ports = []
+
+    def fileno(self):
+        """The inotify fd to watch for readability, None when discovery falls back to polling"""
+        return self._fd
+
+    def rescan(self):
+        """Scan again on the next find(), e.g. after the open port failed"""
+        self._dirty = True
+
+    def poll(self) -> bool:
+        """Drain pending /dev events, returns True when a tty came or went"""
+        if self._fd is None:
+            if time.monotonic() - self._last_scan >= self.fallback_interval:
+                self._dirty = True
+            return self._dirty
+        while True:
+            try:
+                events = os.read(self._fd, 4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not events:
+                break
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(events):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(events, offset)
+                name = events[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length]
+                if name.startswith(b'tty'):
+                    self._dirty = True
+                offset += INOTIFY_EVENT.size + length
+        return self._dirty
+
+    def find_all(self) -> list:
+        """The ListPortInfo of every Module M port, only walks the ports after a change in /dev"""
+        if self.poll():
+            self._dirty = False
+            self._last_scan = time.monotonic()
+            self._ports = find_ports(self.vid, self.pid)
+            if not self._ports:
+                logging.info("Module M not found")
+        return self._ports
+
+    def find(self):
+        """The ListPortInfo of the first Module M port or None"""
+        ports = self.find_all()
+        return ports[0] if ports else None
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
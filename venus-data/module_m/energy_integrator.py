@@ -0,0 +1,127 @@
+"""Per-phase energy counters integrated from the phase power.
+
+Module M only sends the total forward and reverse energy. EnergyIntegrator
+integrates the signed power of every phase over the sample timestamps
+(trapezoidal, a sign change in between is split at the zero crossing) and
+books it as forward or reverse energy of that phase. Intervals longer than
+max_gap seconds are not integrated, the power in between is unknown.
+
+Once *D frames arrive, the integrated energy is only used to split the steps
+of the device totals over the phases, so the phase counters always add up to
+the device counters and do not drift away from them:
+
+    L1_forward += (energy_forward - last energy_forward) * L1 integrated / integrated of all phases
+
+Without *D frames the phase counters are the integrated energy.
+"""
+import logging
+
+PHASES = ('L1', 'L2', 'L3')
+COUNTERS = ('energy_forward', 'energy_reverse') + tuple(f'{phase}_{direction}' for phase in PHASES
+                                                        for direction in ('forward', 'reverse'))
+
+
+def _integrate(p0: float, p1: float, seconds: float):
+    """Trapezoidal energy of a segment in power * seconds, returns (forward, reverse)"""
+    if p0 >= 0 and p1 >= 0:
+        return (p0 + p1) / 2 * seconds, 0.0
+    if p0 <= 0 and p1 <= 0:
+        return 0.0, -(p0 + p1) / 2 * seconds
+    crossing = seconds * p0 / (p0 - p1) # the line crosses zero here
+    first = p0 / 2 * crossing
+    second = p1 / 2 * (seconds - crossing)
+    if first > 0:
+        return first, -second
+    return second, -first
+
+
+class EnergyIntegrator:
+
+    def __init__(self, max_gap: float = 5.0, power_unit: float = 1000.0) -> None:
+        self.max_gap = max_gap # seconds, longer intervals between samples are not integrated
+        self.power_unit = power_unit # sample power per W, the service publishes P / 1000 as W
+        self.forward = [0.0, 0.0, 0.0] # Wh per phase
+        self.reverse = [0.0, 0.0, 0.0]
+        self.pending_forward = [0.0, 0.0, 0.0] # Wh integrated since the last step of the device totals
+        self.pending_reverse = [0.0, 0.0, 0.0]
+        self.device_forward = None # device totals the phase counters were last reconciled with, Wh
+        self.device_reverse = None
+        self.gap_seconds = 0.0 # time not integrated because of gaps
+        self._last = None # (timestamp, signed power per phase) of the previous sample
+
+    def add(self, sample):
+        """Integrate a VictronSerialAmpsAndVoltage, *D samples also reconcile with the device totals"""
+        power = sample.signed_powers()
+        last = self._last
+        self._last = (sample.timestamp, power)
+        if last is not None:
+            seconds = sample.timestamp - last[0]
+            if 0 < seconds <= self.max_gap:
+                scale = 1 / (3600 * self.power_unit)
+                for phase in range(3):
+                    forward, reverse = _integrate(last[1][phase], power[phase], seconds)
+                    self.pending_forward[phase] += forward * scale
+                    self.pending_reverse[phase] += reverse * scale
+            elif seconds > self.max_gap:
+                self.gap_seconds += seconds
+        if sample.command == ord('D'):
+            self.reconcile(sample.energy_forward, sample.energy_reverse, power)
+
+    def reconcile(self, energy_forward: int, energy_reverse: int, power=(0, 0, 0)):
+        """Split the steps of the device totals over the phases by the integrated energy"""
+        if self.device_forward is None:
+            # no reference yet, the phase counters start as the totals split over the connected phases
+            active = [phase for phase in range(3) if power[phase]] or [0]
+            for phase in active:
+                self.forward[phase] = energy_forward / len(active)
+                self.reverse[phase] = energy_reverse / len(active)
+            logging.info("Per-phase energy starts from the device totals %d / %d Wh", energy_forward, energy_reverse)
+        else:
+            self._book(self.forward, self.pending_forward, energy_forward - self.device_forward)
+            self._book(self.reverse, self.pending_reverse, energy_reverse - self.device_reverse)
+        if self.device_forward is None or energy_forward != self.device_forward:
+            self.pending_forward = [0.0, 0.0, 0.0]
+        if self.device_reverse is None or energy_reverse != self.device_reverse:
+            self.pending_reverse = [0.0, 0.0, 0.0]
+        self.device_forward = energy_forward
+        self.device_reverse = energy_reverse
+
+    @staticmethod
+    def _book(counters, pending, step):
+        if step == 0:
+            return # keep integrating until the device counter moves
+        if step < 0:
+            logging.warning("Device energy counter went back %d Wh, keeping the phase counters", step)
+            return
+        integrated = sum(pending)
+        for phase in range(3):
+            counters[phase] += step * pending[phase] / integrated if integrated else step / 3
+
+    def phase_energy(self):
+        """((forward, reverse) Wh per phase)"""
+        if self.device_forward is None: # not reconciled, the integrated energy is all there is
+            return tuple((self.forward[phase] + self.pending_forward[phase],
+                          self.reverse[phase] + self.pending_reverse[phase]) for phase in range(3))
+        return tuple(zip(self.forward, self.reverse))
+
+    def state(self) -> dict:
+        """Counters for the energy journal, see COUNTERS"""
+        state = {}
+        if self.device_forward is not None:
+            state['energy_forward'] = self.device_forward
+            state['energy_reverse'] = self.device_reverse
+        for phase, (forward, reverse) in zip(PHASES, self.phase_energy()):
+            state[f'{phase}_forward'] = forward
+            state[f'{phase}_reverse'] = reverse
+        return state
+
+    def restore(self, state: dict):
+        """Continue from a journal record, without phase counters the next *D frame splits the totals again"""
+        if not all(f'{phase}_forward' in state and f'{phase}_reverse' in state for phase in PHASES):
+            return
+        for index, phase in enumerate(PHASES):
+            self.forward[index] = state[f'{phase}_forward']
+            self.reverse[index] = state[f'{phase}_reverse']
+        if 'energy_forward' in state and 'energy_reverse' in state:
+            self.device_forward = int(state['energy_forward'])
+            self.device_reverse = int(state['energy_reverse'])
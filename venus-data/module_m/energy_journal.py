@@ -0,0 +1,162 @@
+"""Append-only journal of the energy counters on /data.
+
+The file starts with a header naming the counters, followed by fixed size records:
+
+    uint32 sequence, double time, double counter * n, uint32 crc32 of the record before the crc
+
+Records are only appended when a counter moved more than delta since the last
+record or interval seconds passed, so the eMMC sees a few small writes per hour
+instead of one per frame. A torn record at the end is skipped by its CRC on replay,
+and the file is rewritten then, so the next record is not appended after the torn bytes.
+Once the file holds max_records it is rewritten with only the newest record.
+"""
+import logging
+import os
+import struct
+import time
+import zlib
+
+JOURNAL_FILE = '/data/module_m/energy.journal'
+MAGIC = b'MMEJ'
+HEADER = struct.Struct("=4sBB") # magic, version, length of the counter names that follow
+VERSION = 1
+
+
+def _record_struct(count: int) -> struct.Struct:
+    return struct.Struct(f"=Id{count}dI")
+
+
+class EnergyJournal:
+
+    def __init__(self, path: str = JOURNAL_FILE, counters=('energy_forward', 'energy_reverse'),
+                 interval: float = 300.0, delta: float = 100.0, max_records: int = 4096) -> None:
+        self.path = path
+        self.counters = tuple(counters)
+        self.interval = interval # seconds between records while counters move
+        self.delta = delta # counter change that is written right away
+        self.max_records = max_records
+        self.record = _record_struct(len(self.counters))
+        self.sequence = 0
+        self.values = {} # newest values, written or not
+        self.written = {} # values of the last record
+        self.written_at = 0.0
+        self.records = 0 # records in the file
+        self._fd = None
+        self._retry_at = 0.0 # after a failed write
+
+    def _header(self, counters) -> bytes:
+        names = ','.join(counters).encode()
+        return HEADER.pack(MAGIC, VERSION, len(names)) + names
+
+    def replay(self) -> dict:
+        """Load the newest valid record, returns {counter: value} (empty without a journal).
+        Counters the file does not know are missing from the result."""
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return {}
+        except OSError as e:
+            logging.error("Could not read energy journal %s: %s", self.path, e)
+            return {}
+        if len(data) < HEADER.size:
+            self.compact() # torn header
+            return {}
+        magic, version, names_length = HEADER.unpack_from(data)
+        start = HEADER.size + names_length
+        if magic != MAGIC or version != VERSION or start > len(data):
+            logging.error("%s is not an energy journal, starting a new one", self.path)
+            self.compact()
+            return {}
+        names = data[HEADER.size:start].decode(errors='replace').split(',')
+        record = _record_struct(len(names))
+        count, torn = divmod(len(data) - start, record.size)
+        self.records = count
+        # walk back from the end, only the last record can be torn
+        for index in range(count - 1, -1, -1):
+            offset = start + index * record.size
+            fields = record.unpack_from(data, offset)
+            if zlib.crc32(data[offset:offset + record.size - 4]) != fields[-1]:
+                logging.warning("Skipping corrupt energy journal record %d", index)
+                continue
+            self.sequence = fields[0] + 1
+            values = dict(zip(names, fields[2:-1]))
+            self.values = {name: values[name] for name in self.counters if name in values}
+            self.written = dict(self.values)
+            self.written_at = time.monotonic()
+            if names != list(self.counters) or index != count - 1 or torn:
+                self.compact() # new counter layout or a torn tail, start a clean file
+            logging.info("Replayed energy journal record %d: %s", fields[0], self.values)
+            return dict(self.values)
+        self.compact() # no valid record, appending would keep the garbage in front
+        return {}
+
+    def update(self, values: dict) -> bool:
+        """Remember the newest counter values, returns True when a record was written"""
+        self.values.update(values)
+        if time.monotonic() < self._retry_at:
+            return False
+        if not self.written:
+            return self.flush()
+        if time.monotonic() - self.written_at >= self.interval and self.values != self.written:
+            return self.flush()
+        for name, value in values.items():
+            if abs(value - self.written.get(name, 0)) >= self.delta:
+                return self.flush()
+        return False
+
+    def flush(self) -> bool:
+        """Append the newest values when they were not written yet"""
+        if not self.values or self.values == self.written:
+            return False
+        if self.records >= self.max_records or (self._fd is None and not os.path.exists(self.path)):
+            return self.compact()
+        try:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            os.write(self._fd, self._pack())
+            os.fsync(self._fd)
+        except OSError as e:
+            logging.error("Could not write energy journal %s: %s", self.path, e)
+            self.close()
+            self._retry_at = time.monotonic() + self.interval
+            return False
+        self._written()
+        return True
+
+    def compact(self) -> bool:
+        """Replace the file with one holding just the newest record"""
+        self.close()
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'wb') as file:
+                file.write(self._header(self.counters))
+                if self.values:
+                    file.write(self._pack())
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.path)
+        except OSError as e:
+            logging.error("Could not compact energy journal %s: %s", self.path, e)
+            self._retry_at = time.monotonic() + self.interval
+            return False
+        self.records = 0
+        if self.values:
+            self._written()
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _pack(self) -> bytes:
+        body = self.record.pack(self.sequence, time.time(),
+                                *(float(self.values.get(name, 0)) for name in self.counters), 0)[:-4]
+        return body + struct.pack("=I", zlib.crc32(body))
+
+    def _written(self):
+        self.sequence += 1
+        self.records += 1
+        self.written = dict(self.values)
+        self.written_at = time.monotonic()
@@ -0,0 +1,138 @@
+"""In-memory measurement history with rolling aggregates.
+
+History keeps the last capacity samples in preallocated array columns, so its
+memory does not grow with the uptime. RollingWindow follows one column over
+the last few seconds and keeps its sum, minimum and maximum up to date with
+every sample:
+- the sum is corrected with the samples entering and leaving the window
+- the minimum and maximum come from monotonic deques of sequence numbers,
+  the front is the current extreme
+
+Adding a sample is amortized O(1) per window. A window can not look further back
+than the capacity, with a high frame rate the 15 min window covers the samples held.
+"""
+import collections
+from array import array
+
+COLUMNS = ('I1', 'I2', 'I3', 'U1', 'U2', 'U3', 'P1', 'P2', 'P3')
+
+# (name, seconds), the name is used in the D-Bus path
+WINDOWS = (('1s', 1), ('1min', 60), ('15min', 900))
+
+
+class History:
+    """Ring buffer of samples, a column per measurement plus the timestamps and export flags.
+
+    power is the signed total of P1..P3, negative when exporting.
+    """
+
+    def __init__(self, capacity: int = 4096, windows=WINDOWS, series=('power',)) -> None:
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        # the fields are uint32, the signed sum of three of them needs 64 bits
+        self.columns = {name: array('I', bytes(4 * capacity)) for name in COLUMNS}
+        self.columns['power'] = array('q', bytes(8 * capacity))
+        self.export = array('B', bytes(capacity)) # bit 0..2: export_CT1..3
+        self.count = 0 # samples added since the start, the sequence number of the next sample
+        self.windows = {(column, name): RollingWindow(self, column, seconds)
+                        for column in series for name, seconds in windows}
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def add(self, sample):
+        """Append a VictronSerialAmpsAndVoltage"""
+        seq = self.count
+        if seq >= self.capacity: # the oldest sample is overwritten, windows still holding it let it go first
+            for window in self.windows.values():
+                window.drop_before(seq - self.capacity + 1)
+        index = seq % self.capacity
+        columns = self.columns
+        self.timestamps[index] = sample.timestamp
+        for name in COLUMNS:
+            columns[name][index] = getattr(sample, name)
+        self.export[index] = sample.export_CT1 | sample.export_CT2 << 1 | sample.export_CT3 << 2
+        columns['power'][index] = sum(sample.signed_powers())
+        self.count = seq + 1
+        for window in self.windows.values():
+            window.add(seq, sample.timestamp)
+
+    def value(self, column: str, seq: int) -> int:
+        return self.columns[column][seq % self.capacity]
+
+    def timestamp(self, seq: int) -> float:
+        return self.timestamps[seq % self.capacity]
+
+    def aggregates(self, now: float) -> dict:
+        """{(column, window name): (average, minimum, maximum) or None when the window is empty}"""
+        result = {}
+        for key, window in self.windows.items():
+            window.expire(now)
+            result[key] = window.aggregate()
+        return result
+
+
+class RollingWindow:
+    """Sum, minimum and maximum of one History column over the last seconds"""
+
+    def __init__(self, history: History, column: str, seconds: float) -> None:
+        self.history = history
+        self.column = column
+        self.values = history.columns[column]
+        self.seconds = seconds
+        self.start = 0 # sequence number of the oldest sample in the window
+        self.end = 0 # sequence number after the newest sample
+        self.sum = 0
+        self._min = collections.deque() # sequence numbers with increasing values
+        self._max = collections.deque() # sequence numbers with decreasing values
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def add(self, seq: int, timestamp: float):
+        capacity = self.history.capacity
+        values = self.values
+        value = values[seq % capacity]
+        self.expire(timestamp)
+        if self.end != seq: # samples were added while the window was not fed, start over
+            self.start = seq
+            self.sum = 0
+            self._min.clear()
+            self._max.clear()
+        self.end = seq + 1
+        self.sum += value
+        while self._min and values[self._min[-1] % capacity] >= value:
+            self._min.pop()
+        self._min.append(seq)
+        while self._max and values[self._max[-1] % capacity] <= value:
+            self._max.pop()
+        self._max.append(seq)
+
+    def expire(self, now: float):
+        """Drop the samples older than seconds before now"""
+        timestamps = self.history.timestamps
+        capacity = self.history.capacity
+        start = self.start
+        while start < self.end and timestamps[start % capacity] <= now - self.seconds:
+            start += 1
+        self.drop_before(start)
+
+    def drop_before(self, seq: int):
+        capacity = self.history.capacity
+        values = self.values
+        while self.start < seq and self.start < self.end:
+            self.sum -= values[self.start % capacity]
+            self.start += 1
+        while self._min and self._min[0] < self.start:
+            self._min.popleft()
+        while self._max and self._max[0] < self.start:
+            self._max.popleft()
+
+    def aggregate(self):
+        """(average, minimum, maximum), None when the window is empty"""
+        if self.start == self.end:
+            return None
+        capacity = self.history.capacity
+        return (self.sum / (self.end - self.start),
+                self.values[self._min[0] % capacity],
+                self.values[self._max[0] % capacity])
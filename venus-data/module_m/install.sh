@@ -14,12 +14,15 @@ sleep 2
 echo "Generate start and stop scripts.."
 # Kill script
 echo "#!/bin/bash" > "$SCRIPT_DIR/kill_me.sh"
-echo "kill \$(pgrep -f \"python $SCRIPT_DIR/dbus-homemanager.py\")" >> "$SCRIPT_DIR"/kill_me.sh
+# SIGTERM flushes the energy journal, the service runs as python3, "python " never matched it
+echo "kill \$(pgrep -f \"python3 $SCRIPT_DIR/dbus-homemanager.py\")" >> "$SCRIPT_DIR"/kill_me.sh
 
 # Run script
 mkdir -p "$SCRIPT_DIR/service"
 echo "#!/bin/bash" > "$SCRIPT_DIR/service/run"
-echo "python3 $SCRIPT_DIR/dbus-homemanager.py >> $SCRIPT_DIR/dbus-homemanager.log 2>&1 &" >> "$SCRIPT_DIR/service/run"
+# exec in the foreground: supervise watches python itself, restarts it only when it exits and
+# sends svc -h / svc -d (SIGHUP / SIGTERM) to it instead of to a shell that already returned
+echo "exec python3 $SCRIPT_DIR/dbus-homemanager.py --log-file $SCRIPT_DIR/dbus-homemanager.log > /dev/null 2>&1" >> "$SCRIPT_DIR/service/run"
 
 echo "Marking files as executable.."
 chmod +x "$SCRIPT_DIR/dbus-homemanager.py"
@@ -39,4 +42,22 @@ if [ $(grep -c "ln -s $SCRIPT_DIR/service /service/venus-homemanager" /data/rc.l
   echo "ln -s $SCRIPT_DIR/service /service/venus-homemanager" >> /data/rc.local
 fi
 
+# the release manifest lists every file of venus-data.tgz, see zip_file.py
+manifest="$SCRIPT_DIR/MANIFEST"
+installed="$SCRIPT_DIR/.installed-manifest"
+if [ -f "$manifest" ]; then
+  if ! (cd /data && sha256sum -c --quiet "$manifest"); then
+    echo "Warning: files differ from the release manifest"
+  fi
+  if [ -f "$installed" ]; then
+    # remove the files of the previous release that this one dropped, e.g. the .pyc of a removed module
+    awk 'NR == FNR { keep[$2]; next } !($2 in keep) { print $2 }' "$manifest" "$installed" | while read -r file; do
+      case "$file" in
+        module_m/*) echo "Removing $file"; rm -f "/data/$file" ;;
+      esac
+    done
+  fi
+  cp "$manifest" "$installed"
+fi
+
 echo "Installation finished!"
\ No newline at end of file
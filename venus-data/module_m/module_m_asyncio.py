@@ -0,0 +1,173 @@
+"""asyncio transport and protocol for Module M.
+
+Reads the tty with loop.add_reader straight into the ModuleM receive buffer, so
+the meter can be consumed next to other asyncio I/O without threads or polling:
+
+    transport, protocol = await open_module_m()
+    await protocol.register()
+    async for mmdata in protocol.frames():
+        print(mmdata)
+
+Only works on event loops that support add_reader for ttys (the default loop on Linux).
+"""
+import asyncio
+import logging
+import os
+import serial
+
+from device_discovery import find_port, stop_serial_starter
+from connection_state import DISCOVERING, REGISTERING
+from module_m_decoder import ModuleM, WINDOWS, SERIAL_SETTINGS
+
+
+class SerialTransport(asyncio.Transport):
+    """Non blocking transport around an opened serial.Serial, readable through loop.add_reader"""
+
+    def __init__(self, loop, ser, protocol: asyncio.BufferedProtocol) -> None:
+        super().__init__(extra={'serial': ser})
+        self._loop = loop
+        self._ser = ser
+        self._fd = ser.fileno()
+        self._protocol = protocol
+        self._closing = False
+        self._reading = False
+        self._loop.call_soon(self._protocol.connection_made, self)
+        self._loop.call_soon(self.resume_reading)
+
+    def _read_ready(self):
+        buffer = self._protocol.get_buffer(-1)
+        try:
+            count = os.readv(self._fd, [buffer])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._close(e)
+            return
+        if count == 0: # a tty reads EOF once the USB device is gone
+            self._close(ConnectionError('Module M serial port closed'))
+            return
+        self._protocol.buffer_updated(count)
+
+    def write(self, data):
+        if self._closing:
+            return
+        try:
+            self._ser.write(data)
+        except serial.SerialException as e:
+            self._close(e)
+
+    def is_reading(self) -> bool:
+        return self._reading
+
+    def pause_reading(self):
+        if self._reading:
+            self._loop.remove_reader(self._fd)
+            self._reading = False
+
+    def resume_reading(self):
+        if not self._reading and not self._closing:
+            self._loop.add_reader(self._fd, self._read_ready)
+            self._reading = True
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        self._close(None)
+
+    def abort(self):
+        self._close(None)
+
+    def _close(self, exc):
+        if self._closing:
+            return
+        self.pause_reading()
+        self._closing = True
+        self._ser.close()
+        self._loop.call_soon(self._protocol.connection_lost, exc)
+
+
+class ModuleMProtocol(asyncio.BufferedProtocol):
+    """Feeds the bytes from the transport into a ModuleM decoder and wakes up frame waiters"""
+
+    def __init__(self, module_m: ModuleM = None) -> None:
+        self.module_m = module_m if module_m is not None else ModuleM()
+        self.transport = None
+        self._registered = asyncio.Event()
+        self._frame = asyncio.Event()
+        self._frames_received = 0
+        self._frames_delivered = 0
+        self._lost = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.module_m.connection.set(REGISTERING, transport.get_extra_info('serial').port)
+        self.module_m.register_backoff.reset()
+
+    def connection_lost(self, exc):
+        self._lost = exc if exc is not None else ConnectionError('Module M connection closed')
+        self.module_m.connection.set(DISCOVERING)
+        # wake up everyone waiting, they see the connection is gone
+        self._registered.set()
+        self._frame.set()
+
+    def get_buffer(self, sizehint):
+        return self.module_m.receive_buffer()
+
+    def buffer_updated(self, nbytes):
+        frames = self.module_m.received(nbytes)
+        if self.module_m.mmregistered:
+            self._registered.set()
+        if frames:
+            self._frames_received += frames
+            self._frame.set()
+
+    async def register(self):
+        """Send *A until Module M confirms with *B, retried with the ModuleM register backoff.
+        Wrap in asyncio.wait_for for a timeout"""
+        while not self.module_m.mmregistered:
+            if self._lost is not None:
+                raise self._lost
+            logging.info("Registering VictronGX, sending *A")
+            self.transport.write(b'*A\n') # RegisterVictronGX_sendBackConfirmation
+            try:
+                await asyncio.wait_for(self._registered.wait(), self.module_m.register_backoff.failed())
+            except asyncio.TimeoutError:
+                pass
+        return self.module_m.serialnumber
+
+    async def next_frame(self):
+        """Wait for the next decoded measurement and return the newest mmdata"""
+        if self._lost is None and self._frames_received == self._frames_delivered:
+            self._frame.clear()
+            await self._frame.wait()
+        if self._lost is not None:
+            raise self._lost
+        self._frames_delivered = self._frames_received
+        return self.module_m.mmdata
+
+    async def frames(self):
+        """Yields the newest mmdata after every batch of decoded frames until the connection is lost"""
+        while True:
+            try:
+                yield await self.next_frame()
+            except ConnectionError:
+                return
+
+
+async def open_module_m(port: str = None, protocol: ModuleMProtocol = None):
+    """Open Module M (found by VID/PID when port is None) and return (transport, protocol)"""
+    loop = asyncio.get_running_loop()
+    if port is None:
+        port_info = find_port()
+        if port_info is None:
+            raise ConnectionError("Module M not found")
+        port = port_info.name
+        if not WINDOWS:
+            port = f"/dev/{port}"
+            stop_serial_starter(port_info.name)
+    ser = serial.Serial(port, **SERIAL_SETTINGS)
+    if protocol is None:
+        protocol = ModuleMProtocol(ModuleM(ser))
+    transport = SerialTransport(loop, ser, protocol)
+    return transport, protocol
@@ -0,0 +1,75 @@
+"""Optional settings of the Module M service.
+
+The service reads /data/module_m/config.ini when it exists, see config.sample.ini
+for the available sections. A missing file or option means the built in default.
+
+Meters are told apart by the serial number they send in *B. MeterRegistry gives
+every serial number a role and a device instance, from a [meter <serial>] section
+in config.ini, or assigned once and remembered in /data/module_m/meters.ini so a
+meter keeps its device instance when the USB ports are enumerated differently.
+"""
+import configparser
+import logging
+
+CONFIG_FILE = '/data/module_m/config.ini'
+METERS_FILE = '/data/module_m/meters.ini'
+ROLES = ('grid', 'acload', 'pvinverter')
+GRID_DEVICE_INSTANCE = 40 # the device instance of the single meter service before
+
+
+def load_config(path: str = CONFIG_FILE) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(path) # silently skips a missing file
+    return config
+
+
+class MeterRegistry:
+
+    def __init__(self, config: configparser.ConfigParser, path: str = METERS_FILE) -> None:
+        self.config = config
+        self.path = path
+        self.assigned = configparser.ConfigParser()
+        self.assigned.read(path)
+
+    def _sections(self):
+        for source in (self.config, self.assigned):
+            for section in source.sections():
+                kind, _, serial = section.partition(' ')
+                if kind == 'meter' and serial:
+                    yield serial.strip(), source[section]
+
+    def lookup(self, serial: str) -> dict:
+        """{'role', 'deviceinstance', 'position'} of the meter, a new meter is assigned and saved"""
+        for known, options in self._sections():
+            if known == serial:
+                return self._settings(options)
+        # the first meter becomes the grid meter of the single meter service, the next ones ac loads
+        meters = [self._settings(options) for _, options in self._sections()]
+        used = {meter['deviceinstance'] for meter in meters}
+        if not any(meter['role'] == 'grid' for meter in meters) and GRID_DEVICE_INSTANCE not in used:
+            role, instance = 'grid', GRID_DEVICE_INSTANCE
+        else:
+            role, instance = 'acload', GRID_DEVICE_INSTANCE + 1
+            while instance in used:
+                instance += 1
+        section = f'meter {serial}'
+        self.assigned[section] = {'role': role, 'deviceinstance': str(instance)}
+        try:
+            with open(self.path, 'w') as file:
+                self.assigned.write(file)
+        except OSError as e:
+            logging.error("Could not save the meter assignments to %s: %s", self.path, e)
+        logging.info("New meter %s: %s with device instance %d", serial, role, instance)
+        return self._settings(self.assigned[section])
+
+    @staticmethod
+    def _settings(options) -> dict:
+        role = options.get('role', 'grid')
+        if role not in ROLES:
+            logging.error("Unknown meter role %s, using grid", role)
+            role = 'grid'
+        return {
+            'role': role,
+            'deviceinstance': options.getint('deviceinstance', GRID_DEVICE_INSTANCE),
+            'position': options.getint('position', 0), # pvinverter: 0 AC input 1, 1 AC output, 2 AC input 2
+        }
@@ -1,19 +1,22 @@
-import copy
-import select
+import collections
+import errno
 import struct
 import logging
-import socket
+import os
 import sys
 import time
 import serial
-import serial.tools.list_ports
-import subprocess
-
-VID = 0x239A
-PID = 0x80A4
+from device_discovery import DeviceDiscovery, stop_serial_starter
+from capture import CaptureWriter, SENT
+from stats import Histogram
+from connection_state import Backoff, ConnectionState, DISCOVERING, OPENING, REGISTERING, STREAMING, STALE
 
 # Open the serial port
 WINDOWS = sys.platform.startswith('win')
+# the port is held by another process, e.g. a second copy of the service, see SERIAL_SETTINGS
+PORT_BUSY = (errno.EBUSY, errno.EAGAIN, errno.EWOULDBLOCK)
+# exclusive: a second process can not open the port and read bytes of the first one
+SERIAL_SETTINGS = dict(baudrate=9600, timeout=0, rtscts=False, dsrdtr=False, xonxoff=False, exclusive=True)
 
 """struct VictronSerialAmpsAndVoltage {
         uint8_t magic_start; // * 
@@ -32,259 +35,493 @@ WINDOWS = sys.platform.startswith('win')
         uint32_t P3;
     };"""
 
-class VictronSerialAmpsAndVoltage:
-    def __init__(self) -> None:
-        self.command: int = 0
-        self.export_CT1: bool = False
-        self.export_CT2: bool = False
-        self.export_CT3: bool = False
-        self.I1: int = 0 # mA
-        self.I2: int = 0
-        self.I3: int = 0
-        self.U1: int = 0 # mV
-        self.U2: int = 0
-        self.U3: int = 0
-        self.P1: int = 0 # Watt
-        self.P2: int = 0
-        self.P3: int = 0 
-        self.energy_forward: int = 0 # Wh
-        self.energy_reverse: int = 0
-        
-    
-    def set_all_to_zero(self):
-        self.I1 = 0
-        self.I2 = 0
-        self.I3 = 0
-        # self.U1 = 0 # let voltage be normal
-        # self.U2 = 0
-        # self.U3 = 0
-        self.P1 = 0
-        self.P2 = 0
-        self.P3 = 0
+SAMPLE_FIELDS = ('timestamp', 'command', 'export_CT1', 'export_CT2', 'export_CT3',
+                 'I1', 'I2', 'I3', # mA
+                 'U1', 'U2', 'U3', # mV
+                 'P1', 'P2', 'P3', # Watt
+                 'energy_forward', 'energy_reverse') # Wh
+
+
+def signed_power(power: int, export: bool) -> int:
+    """The Module M sends the power of a phase unsigned, export_CTn is set while phase n feeds in"""
+    return -power if export else power
+
+
+class VictronSerialAmpsAndVoltage(collections.namedtuple('VictronSerialAmpsAndVoltage', SAMPLE_FIELDS,
+                                                         defaults=(0.0, 0, False, False, False) + (0,) * 11)):
+    """One immutable measurement sample.
+
+    timestamp is the time.monotonic() arrival time, command the frame it came from (ord('C') or ord('D')).
+    The decoder replaces ModuleM.mmdata with a new sample for every frame, so a sample
+    can be kept or shared between readers without copying.
+    """
+    __slots__ = ()
+
+    def zeroed(self):
+        """Copy without current and power, the voltage stays normal"""
+        return self._replace(I1=0, I2=0, I3=0, P1=0, P2=0, P3=0)
+
+    def signed_powers(self) -> tuple:
+        """(P1, P2, P3) negative while exporting, see signed_power()"""
+        return (signed_power(self.P1, self.export_CT1), signed_power(self.P2, self.export_CT2),
+                signed_power(self.P3, self.export_CT3))
 
     def __str__(self) -> str:
         return f"command: {self.command}, AC Phase L1: {self.U1 / 1000}V {self.I1 / 1000}A {self.P1 / 1000}W. AC Phase L2: {self.U2 / 1000}V {self.I2 / 1000}A {self.P2 / 1000}W. AC Phase L3: {self.U3 / 1000}V {self.I3 / 1000}A {self.P3 / 1000}W  -  ENERGY -> Forward: {self.energy_forward / 1000}kWh. Deverse: {self.energy_reverse / 1000}kWh"
 
 
+class ReceiveBuffer:
+    """Preallocated receive buffer with a read and a write cursor.
+
+    Serial data is read straight into the free space with readinto(). Decoded
+    frames and garbage are dropped by moving the read cursor, so nothing is
+    copied per byte. The unread tail is only moved back to the start of the
+    buffer when the write cursor runs out of room.
+    """
+
+    def __init__(self, size: int = 4096) -> None:
+        self.size = size
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.read_pos = 0
+        self.write_pos = 0
+
+    def __len__(self) -> int:
+        return self.write_pos - self.read_pos
+
+    def __bytes__(self) -> bytes:
+        return bytes(self.view[self.read_pos:self.write_pos])
+
+    def free(self) -> int:
+        return self.size - len(self)
+
+    def clear(self):
+        self.read_pos = 0
+        self.write_pos = 0
+
+    def _compact(self):
+        length = len(self)
+        if length and self.read_pos:
+            self.view[:length] = self.view[self.read_pos:self.write_pos]
+        self.read_pos = 0
+        self.write_pos = length
+
+    def writable(self) -> memoryview:
+        """Free space behind the write cursor, announce what was written with commit()"""
+        if self.read_pos and self.size - self.write_pos < self.size // 2:
+            self._compact()
+        return self.view[self.write_pos:]
+
+    def commit(self, count: int):
+        self.write_pos = min(self.write_pos + count, self.size)
+
+    def fill_from(self, ser, count: int) -> int:
+        """Read up to count bytes from ser into the free space, returns the amount read"""
+        if self.size - self.write_pos < count:
+            self._compact()
+        count = min(count, self.size - self.write_pos)
+        if count <= 0:
+            return 0
+        read = ser.readinto(self.view[self.write_pos:self.write_pos + count]) or 0
+        self.write_pos += read
+        return read
+
+    def startswith(self, prefix: bytes) -> bool:
+        return self.data.startswith(prefix, self.read_pos, self.write_pos)
+
+    def find(self, sub: bytes, start: int = 0) -> int:
+        """Offset of sub relative to the read cursor, or -1"""
+        index = self.data.find(sub, self.read_pos + start, self.write_pos)
+        return index - self.read_pos if index >= 0 else -1
+
+    def byte_at(self, offset: int) -> int:
+        return self.data[self.read_pos + offset]
+
+    def slice(self, start: int, end: int) -> bytes:
+        return bytes(self.view[self.read_pos + start:self.read_pos + end])
+
+    def consume(self, count: int):
+        self.read_pos = min(self.read_pos + count, self.write_pos)
+        if self.read_pos == self.write_pos:
+            self.clear()
+
+    def resync(self, start: int = 0) -> int:
+        """Drop everything before the next magic start byte, returns the amount dropped"""
+        index = self.find(b'*', start)
+        dropped = index if index >= 0 else len(self)
+        self.consume(dropped)
+        return dropped
+
+
+class FrameSpec:
+    """Layout of one Module M frame, registered in FRAMES under its command byte.
+
+    fields maps the unpacked struct members to attribute names, None skips a member.
+    sample_layout pairs the VictronSerialAmpsAndVoltage position of a member with its
+    position in the struct.
+    For frames without a fixed size, length(rx, spec) returns the full frame size
+    or 0 while the frame is still incomplete.
+    """
+
+    def __init__(self, command: bytes, fmt: str, fields: tuple, handler: str, length=None) -> None:
+        self.command = command
+        self.codec = struct.Struct(fmt)
+        self.size = self.codec.size
+        self.fields = fields
+        self.sample_layout = tuple((SAMPLE_FIELDS.index(name), index) for index, name in enumerate(fields)
+                                   if name in SAMPLE_FIELDS)
+        self.handler = handler
+        self.length = length
+
+    def frame_length(self, rx: ReceiveBuffer) -> int:
+        if self.length is None:
+            return self.size
+        return self.length(rx, self)
+
+
+def _error_frame_length(rx: ReceiveBuffer, spec: FrameSpec) -> int:
+    if len(rx) < spec.size:
+        return 0
+    end = spec.size
+    for _ in range(rx.byte_at(2)):
+        index = rx.find(b"\r\n", end)
+        if index < 0:
+            return 0
+        end = index + 2
+    return end
+
+
+AMPS_AND_VOLTAGE_FIELDS = (None, 'command', 'export_CT1', 'export_CT2', 'export_CT3',
+                           'I1', 'I2', 'I3', 'U1', 'U2', 'U3', 'P1', 'P2', 'P3')
+
+FRAMES = {spec.command[0]: spec for spec in (
+    # RegisterVictronGXConfirmation: *B followed by the 11 byte serial number
+    FrameSpec(b'B', "=2B11s", (None, None, 'serialnumber'), '_handle_registration'),
+    # struct VictronSerialAmpsAndVoltage, see above
+    FrameSpec(b'C', "=2B3?9I", AMPS_AND_VOLTAGE_FIELDS, '_handle_measurement'),
+    # struct VictronSerialAmpsVoltageAndEnergy {
+    #     struct VictronSerialAmpsAndVoltage ampsAndVoltage;
+    #     uint32_t energy_delivered; // Wh
+    #     uint32_t energy_returned; // Wh
+    # };
+    FrameSpec(b'D', "=2B3?9I2I", AMPS_AND_VOLTAGE_FIELDS + ('energy_forward', 'energy_reverse'), '_handle_measurement'),
+    # struct VictronSerialErrorCodes {
+    #     uint8_t magic_start;
+    #     uint8_t command;
+    #     uint8_t errorCodeLines; // the amount of lines that follow (\r\n) with error messages
+    # };
+    FrameSpec(b'E', "=3B", (None, None, 'error_code_lines'), '_handle_errors', length=_error_frame_length),
+)}
+
+
 class ModuleM:
 
-    def __init__(self):
-        self.ser = serial.Serial(None, 9600, timeout=0, rtscts=False, dsrdtr=False, xonxoff=False)
-        self.datagram = b""
+    def __init__(self, ser=None, port: str = None, discovery: DeviceDiscovery = None):
+        # the serial port is only read by _read_data, the asyncio transport feeds the decoder through received()
+        self.ser = ser if ser is not None else serial.Serial(None, **SERIAL_SETTINGS)
+        self.port = port # fixed port, e.g. the pty of tests/module_m_emulator.py, instead of finding Module M by VID/PID
+        self.rxbuffer = ReceiveBuffer()
+        self.discovery = discovery if discovery is not None else DeviceDiscovery() # can be shared by several ModuleM
+        self.reconnect = True # (re)open the port when it is closed, the multi-meter service opens the ports itself
         self.serialnumber = None
         self.mmdata = VictronSerialAmpsAndVoltage()
-        self.mmregistered = False # module m registered with *B command
         self.last_update = time.time()
-        self.mmregistered_last_register_request = time.time()
+        self.stale_timeout = 2 # seconds without frames before the link counts as stale
+        self.sample_listeners = [] # called with every new sample, also the ones read_frames coalesces
+        self.clock = time.monotonic # sample timestamps, a capture replay substitutes the capture time
+        self.capture = None # CaptureWriter recording the raw tty traffic, see start_capture
+
+        # connection state machine, attempts to open the port or register are spaced out when they keep failing
+        self.connection = ConnectionState()
+        self.open_backoff = Backoff(initial=1, maximum=60) # reset once streaming, so a flapping link backs off
+        self.register_backoff = Backoff(initial=2, maximum=60)
 
-        # communication signals for dbus-homemanager
-        self.new_port_name = False
-        self.new_serialnumber = False
         self.errors = []
         self.errors_show_index = 0 # the current displayed error in victron
 
+        # backlog accounting, see read_frames
+        self.frames_decoded = 0 # measurement frames decoded
+        self.frames_coalesced = 0 # decoded frames overwritten by a newer one in the same read_frames call
+        self.frames_skipped = 0 # unknown, unregistered or overflowed frames that were thrown away
+        self.bytes_discarded = 0 # garbage bytes dropped while searching for the magic start
+
+        # runtime counters, published under /Mgmt/Stats, see stats.py
+        self.bytes_received = 0
+        self.short_reads = 0 # decode attempts that had to wait for the rest of a frame
+        self.registration_requests = 0 # *A sent
+        self.port_opens = 0
+        self.decode_latency = Histogram() # seconds from the arrival of the first byte of a frame to its decode
+        self._arrived = None # time.monotonic() of the read that brought the oldest pending byte
+        self._last_read = None
+
+    def read_frames(self) -> int:
+        """Drain the serial port and decode every complete frame in the receive buffer.
+
+        Returns the number of measurement frames decoded. mmdata always holds the newest
+        one, the older frames of the same call are counted in frames_coalesced.
+        """
+        frames = 0
+        while self._read_data():
+            frames += self._decode_buffered()
+            try:
+                if self.ser.in_waiting == 0:
+                    break
+            except Exception: # port went away, _read_data handles it on the next call
+                break
+        if frames > 1:
+            self.frames_coalesced += frames - 1
+        if self.connection.state == STREAMING and time.time() - self.last_update > self.stale_timeout:
+            self.connection.set(STALE)
+        return frames
+
+    def start_capture(self, path: str):
+        """Record every byte read from and written to the tty in a capture file, see capture.py"""
+        self.stop_capture()
+        self.capture = CaptureWriter(path)
+        if self.mmregistered and self.serialnumber is not None:
+            # the registration happened before the capture, a replay needs it to decode the frames
+            self.capture.write(b'*B' + self.serialnumber)
+        logging.info("Capturing the Module M serial data to %s", path)
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            logging.info("Captured %d bytes to %s", self.capture.bytes, self.capture.path)
+            self.capture = None
+
+    def _received(self, count: int):
+        """Account count bytes that were just added to the receive buffer"""
+        if count:
+            self.bytes_received += count
+            self._last_read = time.monotonic()
+            if len(self.rxbuffer) == count: # the buffer was empty, a new frame starts with these bytes
+                self._arrived = self._last_read
+
+    def _captured(self, count: int):
+        rx = self.rxbuffer
+        self.capture.write(rx.view[rx.write_pos - count:rx.write_pos])
+
+    @property
+    def mmregistered(self) -> bool:
+        """module m registered with *B command"""
+        return self.connection.state in (STREAMING, STALE)
+
+    def receive_buffer(self) -> memoryview:
+        """Free space of the receive buffer for callers that read the port themselves, see received()"""
+        if self.rxbuffer.free() == 0: # no complete frame in a full buffer, start over
+            logging.warning('receive buffer overflow, dropping %d bytes', len(self.rxbuffer))
+            self.frames_skipped += 1
+            self.rxbuffer.clear()
+        return self.rxbuffer.writable()
+
+    def received(self, count: int) -> int:
+        """Decode after count bytes were written into receive_buffer(), returns the measurement frames decoded"""
+        self.rxbuffer.commit(count)
+        self._received(count)
+        if self.capture is not None:
+            self._captured(count)
+        self.bytes_discarded += self.rxbuffer.resync()
+        frames = self._decode_buffered()
+        if frames > 1:
+            self.frames_coalesced += frames - 1
+        return frames
+
+    def feed(self, data) -> int:
+        """Decode bytes that were read elsewhere, returns the measurement frames decoded"""
+        data = memoryview(data)
+        frames = 0
+        while data:
+            buffer = self.receive_buffer()
+            count = min(len(buffer), len(data))
+            buffer[:count] = data[:count]
+            data = data[count:]
+            frames += self.received(count)
+        return frames
+
+    def _decode_buffered(self) -> int:
+        frames = 0
+        while len(self.rxbuffer) >= 2:
+            pending = len(self.rxbuffer)
+            if self._decode_data():
+                frames += 1
+            elif len(self.rxbuffer) == pending: # incomplete frame, wait for more data
+                break
+        self.frames_decoded += frames
+        return frames
+
     def _read_data(self):
         try:
             in_waiting = self.ser.in_waiting
             ready = in_waiting > 0
         except Exception as e: # attribute error is thrown when no port passed to serial.Serial
-            print("Serial port closed")
-            self.mmregistered = False
             if self.ser.port is not None and self.ser.is_open:
+                logging.warning("Serial port closed")
                 self.ser.close()
-            for port in serial.tools.list_ports.comports():
-                if port.vid == VID and port.pid == PID:
-                    port_name = port.name
-                    if not WINDOWS:
-                        port_name = f"/dev/{port_name}"
-                        try:
-                            subprocess.run(["/opt/victronenergy/serial-starter/stop-tty.sh", port.name])
-                        except subprocess.CalledProcessError as e:
-                            # Handle cases where the command fails
-                            print(f"stop serial starter command CalledProcessError with return code: {e.returncode}")
-                        except FileNotFoundError:
-                            # Handle case where the script is not found
-                            print("The stop serial starter command or script does not exist. Please check the path.")
-                    self.ser.port = port_name
-                    self.new_port_name = True
-                    print(f"Found Module M on {port_name}")
-                    self.ser.open()
-                    in_waiting = self.ser.in_waiting
-                    ready = in_waiting > 0
-                    break
+                self.discovery.rescan()
+            self.connection.set(DISCOVERING)
+            self.rxbuffer.clear()
+            if not self.reconnect or not self.open_backoff.ready():
+                return False
+            if self.port is not None:
+                if not os.path.exists(self.port):
+                    return False
+                port_name = self.port
             else:
-                print("Module M not found")
+                port = self.discovery.find() # cheap until a tty appears or disappears
+                if port is None:
+                    return False
+                port_name = port.name
+                if not WINDOWS:
+                    port_name = f"/dev/{port_name}"
+                    stop_serial_starter(port.name)
+            self.ser.port = port_name
+            self.connection.set(OPENING, port_name)
+            self.open_backoff.failed() # until the link is streaming
+            try:
+                self.port_opens += 1
+                self.ser.open()
+                in_waiting = self.ser.in_waiting
+            except (serial.SerialException, OSError) as e:
+                if getattr(e, 'errno', None) in PORT_BUSY: # skipped, nothing is sent to a port in use
+                    logging.warning("%s is in use by another process, skipping it", port_name)
+                    self.connection.set(DISCOVERING)
+                    return False
+                logging.error("Could not open %s: %s", port_name, e)
+                self.discovery.rescan()
+                self.connection.set(DISCOVERING)
                 return False
+            logging.info("Found Module M on %s", port_name)
+            self.connection.set(REGISTERING)
+            self.register_backoff.reset() # register right away
+            ready = in_waiting > 0
             
-        if not self.mmregistered and time.time() - self.mmregistered_last_register_request > 2:
-            self.mmregistered_last_register_request = time.time()
-            print("Registering VictronGX, sending *A")
+        if not self.mmregistered and self.register_backoff.ready():
+            self.register_backoff.failed() # schedules the retry in case *B does not come
+            logging.info("Registering VictronGX, sending *A")
             try:
+                self.registration_requests += 1
                 self.ser.write(b'*A\n') # RegisterVictronGX_sendBackConfirmation
+                if self.capture is not None:
+                    self.capture.write(b'*A\n', SENT)
             except serial.SerialException as e:
                 logging.error('Could not write to serial port: %s', e.args[0])
             return False
 
-        if not ready and self.datagram == b'':
+        if not ready and len(self.rxbuffer) == 0:
             # print('no data ready')
             return False
 
-        self.datagram += self.ser.read(in_waiting)
-        while len(self.datagram) > 1 and self.datagram[:1] != b'*': # remove garbage data
-            # print('removing garbage data: ', self.datagram[:1])
-            self.datagram = self.datagram[1:]
-        if len(self.datagram) == 1 and self.datagram[0] != b'*': # remove garbage data
-            self.datagram = b""
-            return False
+        if ready:
+            if self.rxbuffer.free() == 0: # no complete frame in a full buffer, start over
+                logging.warning('receive buffer overflow, dropping %d bytes', len(self.rxbuffer))
+                self.frames_skipped += 1
+                self.rxbuffer.clear()
+            count = self.rxbuffer.fill_from(self.ser, in_waiting)
+            self._received(count)
+            if self.capture is not None and count:
+                self._captured(count)
+        self.bytes_discarded += self.rxbuffer.resync() # remove garbage data in front of the magic start
         
-        return True
+        return len(self.rxbuffer) >= 2
 
 
-    def _decode_data(self):    
-        if self.datagram[:1] != b'*':
-            print('wrong magic start: ', self.datagram)
-            self.datagram = self.datagram[1:]
+    def _decode_data(self):
+        rx = self.rxbuffer
+        if not rx.startswith(b'*'):
+            logging.debug('wrong magic start, %d bytes pending', len(rx))
+            self.bytes_discarded += rx.resync(1)
             return False
         
-        if self.datagram[1:2] not in [b"B", b"C", b"D", b"E"]:
-            print('command not recognized: ', self.datagram)
-            self.datagram = self.datagram[2:]
+        spec = FRAMES.get(rx.byte_at(1)) if len(rx) >= 2 else None
+        if spec is None:
+            logging.warning('command not recognized: %r', rx.slice(0, 2))
+            self.frames_skipped += 1
+            self.bytes_discarded += rx.resync(1)
             return False
         self.last_update = time.time()
         
-        if not self.mmregistered:
-            # search for the registration command inside the datagram
-            while len(self.datagram) > 2 and self.datagram[:2] != b'*B': # remove garbage data until we find RegisterVictronGXConfirmation
-                self.datagram = self.datagram[1:]
-
-            if len(self.datagram) >= 13:
-                self.mmregistered = True
-                self.datagram = self.datagram[2:13]
-                self.serialnumber = copy.deepcopy(self.datagram)
-                self.new_serialnumber = True
-                print("Module M registered")
+        if not self.mmregistered and spec.command != b'B':
+            # search for the registration command inside the datagram, drop the garbage in front of it
+            index = rx.find(b'*B')
+            if index < 0:
+                logging.debug('module m not registered, trowing away %d bytes', len(rx) - 1)
+                self.frames_skipped += 1
+                self.bytes_discarded += len(rx) - 1
+                rx.consume(len(rx) - 1) # a trailing '*' might be the start of *B
+                self.bytes_discarded += rx.resync()
                 return False
-            print('module m not registered, trowing away data: ', self.datagram)
-            self.datagram = b""
+            self.frames_skipped += 1
+            self.bytes_discarded += index
+            rx.consume(index)
+            spec = FRAMES[ord('B')]
+
+        size = spec.frame_length(rx)
+        if size == 0 or len(rx) < size:
+            logging.debug('not enough data: %d bytes', len(rx))
+            self.short_reads += 1
             return False
+        # Parse the data. the recieved data is in the form of the c struct in the frame table
+        unpacked_data = spec.codec.unpack_from(rx.data, rx.read_pos)
+        payload = rx.slice(spec.size, size) if size > spec.size else b'' # what follows the struct, the *E lines
+        # consumed before the handler runs, a handler or listener that raises must not get the same frame again
+        rx.consume(size)
+        return getattr(self, spec.handler)(spec, unpacked_data, payload)
 
-        if self.datagram[:2] == b'*E':  # Errors
-            """struct VictronSerialErrorCodes {
-                uint8_t magic_start;
-                uint8_t command;
-                uint8_t errorCodeLines; // the amount of lines that follow (\n) with error messages
-            };"""
-            print("recieved errors")
-            if len(self.datagram) < 3:
-                print('not enough data: ', self.datagram)
-                return False
-            # Parse the data. the recieved data is in the form of the above c struct
-            unpacked_data = struct.unpack("=3B", self.datagram[0:3])
-            if (unpacked_data[2] == 0):
-                self.errors = []
-                self.datagram = self.datagram[3:]
-                return False
-            errors = self.datagram.split(b"\r\n")
-            if len(errors) < unpacked_data[2]:
-                print('not enough data: ', self.datagram)
-                return False
-            errors[0] = errors[0][3:] # remove the first 3 bytes
-            self.errors = errors[:unpacked_data[2]] # remove any extra data
-            self.datagram = b"" # remove any extra data
-            print("got ", unpacked_data[2], " new errors: ", self.errors)        
-              
-            
+    def _handle_registration(self, spec, unpacked_data, payload):
+        self.serialnumber = unpacked_data[2]
+        self.connection.set(STREAMING)
+        self.register_backoff.reset()
+        self.open_backoff.reset()
+        logging.info("Module M registered, serial number %r", self.serialnumber)
+        return False
 
-        if self.datagram[:2] == b'*C':  # AmpsAndVoltage
-            """struct VictronSerialAmpsAndVoltage {
-                        uint8_t magic_start; // * 
-                        uint8_t command;     // C
-                        bool export_CT1;
-                        bool export_CT2;
-                        bool export_CT3;
-                        uint32_t I1; // mA
-                        uint32_t I2;
-                        uint32_t I3;
-                        uint32_t U1; // mV
-                        uint32_t U2;
-                        uint32_t U3;
-                        uint32_t P1; // W
-                        uint32_t P2;
-                        uint32_t P3;
-                    };"""
-            if len(self.datagram) < 41:
-                print('not enough data: ', self.datagram)
-                return False
-            print(f"Unpacked data length: {len(self.datagram)}")
-            # Parse the data. the recieved data is in the form of the above c struct
-            unpacked_data = struct.unpack("=2B3B9I", self.datagram[0:41])
-            self.datagram = self.datagram[41:]
-
-            self.mmdata.command = unpacked_data[1]
-            self.mmdata.export_CT1 = bool(unpacked_data[2])
-            self.mmdata.export_CT2 = bool(unpacked_data[3])
-            self.mmdata.export_CT3 = bool(unpacked_data[4])
-            self.mmdata.I1 = unpacked_data[5]
-            self.mmdata.I2 = unpacked_data[6]
-            self.mmdata.I3 = unpacked_data[7]
-            self.mmdata.U1 = unpacked_data[8]
-            self.mmdata.U2 = unpacked_data[9]
-            self.mmdata.U3 = unpacked_data[10]
-            self.mmdata.P1 = unpacked_data[11]
-            self.mmdata.P2 = unpacked_data[12]
-            self.mmdata.P3 = unpacked_data[13]
-            # do not alter energy values. They stay the same until new *D data is received
-            print("got new data: ", self.mmdata)    
-            return True   
-        
-        if self.datagram[:2] == b'*D':  # Energy
-            """struct VictronSerialAmpsVoltageAndEnergy {
-                        struct VictronSerialAmpsAndVoltage ampsAndVoltage;
-                        uint32_t energy_delivered; // Wh
-                        uint32_t energy_returned; // Wh
-                    };"""
-            if len(self.datagram) < 49:
-                print('not enough data: ', self.datagram)
-                return False
-            print(f"Unpacked data length: {len(self.datagram)}")
-            # Parse the data. the recieved data is in the form of the above c struct
-            unpacked_data = struct.unpack("=2B3B9I2I", self.datagram[0:49])
-            self.datagram = self.datagram[41:]
-
-            self.mmdata.command = unpacked_data[1]
-            self.mmdata.export_CT1 = bool(unpacked_data[2])
-            self.mmdata.export_CT2 = bool(unpacked_data[3])
-            self.mmdata.export_CT3 = bool(unpacked_data[4])
-            self.mmdata.I1 = unpacked_data[5]
-            self.mmdata.I2 = unpacked_data[6]
-            self.mmdata.I3 = unpacked_data[7]
-            self.mmdata.U1 = unpacked_data[8]
-            self.mmdata.U2 = unpacked_data[9]
-            self.mmdata.U3 = unpacked_data[10]
-            self.mmdata.P1 = unpacked_data[11]
-            self.mmdata.P2 = unpacked_data[12]
-            self.mmdata.P3 = unpacked_data[13]
-            self.mmdata.energy_forward = unpacked_data[14]
-            self.mmdata.energy_reverse = unpacked_data[15]
-            print("got new data: ", self.mmdata)    
-            return True   
-        
-        print("unknown command: ", self.datagram)
-        self.datagram = b""
+    def _handle_errors(self, spec, unpacked_data, payload):
+        error_code_lines = unpacked_data[2]
+        # the error lines follow the header, each one terminated by \r\n
+        self.errors = payload[:-2].split(b"\r\n") if error_code_lines else []
+        logging.info("got %d new errors: %s", error_code_lines, self.errors)
         return False
 
+    def _handle_measurement(self, spec, unpacked_data, payload):
+        if self.connection.state == STALE:
+            self.connection.set(STREAMING)
+        # fields missing from the frame keep their value, so energy stays the same until new *D data is received
+        sample = list(self.mmdata)
+        for position, index in spec.sample_layout:
+            sample[position] = unpacked_data[index]
+        sample[0] = self.clock()
+        if self._arrived is not None:
+            self.decode_latency.observe(time.monotonic() - self._arrived)
+            self._arrived = self._last_read # the bytes behind this frame came with the last read at the latest
+        self.mmdata = VictronSerialAmpsAndVoltage._make(sample) # swapped in as a whole, readers never see half a frame
+        for listener in self.sample_listeners:
+            try:
+                listener(self.mmdata)
+            except Exception: # one failing listener must not stop the decoding or the other listeners
+                logging.exception("Sample listener %r failed", listener)
+        logging.debug("got new data: %s", self.mmdata)
+        return True
+
 if __name__ == "__main__":
-    sma = ModuleM()
-    for port in serial.tools.list_ports.comports():
-            print(port.vid, port.pid, "desc", port.name)
-    
-    while True:
-        if sma._read_data() and sma._decode_data():
-            # print(sma.mmdata)
-            pass
-        else:
-            if sma.last_update + 5 < time.time():
-                print('not updated for 5 seconds')
-                sma.mmdata.set_all_to_zero()
-        time.sleep(1)
+    import asyncio
+    import serial.tools.list_ports
+    import module_m_asyncio
+    import module_m_logging
+
+    async def main():
+        module_m_logging.setup_logging('DEBUG')
+        for port in serial.tools.list_ports.comports():
+                logging.info("%s %s desc %s", port.vid, port.pid, port.name)
+
+        transport, protocol = await module_m_asyncio.open_module_m()
+        await protocol.register()
+        while True:
+            try:
+                mmdata = await asyncio.wait_for(protocol.next_frame(), 5)
+                # print(mmdata)
+            except asyncio.TimeoutError:
+                logging.warning('not updated for 5 seconds')
+                protocol.module_m.mmdata = protocol.module_m.mmdata.zeroed()
+
+    asyncio.run(main())
     
\ No newline at end of file
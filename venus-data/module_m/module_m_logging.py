@@ -0,0 +1,124 @@
+"""Logging setup of the Module M service.
+
+The log lives on the GX flash, so it is kept small:
+- messages are logged with %-style arguments, they are only formatted when a handler takes them
+- RateLimitFilter lets every warning or error template through a few times per interval and
+  reports how many were suppressed in between, DEBUG and INFO are asked for and pass
+- the file sink rotates at a fixed size
+- RingBufferHandler keeps the last lines in memory, dump_ring_buffer() writes them out on demand
+"""
+import collections
+import logging
+import logging.handlers
+import sys
+import time
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_ring_buffer = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most burst records per message key within interval seconds.
+
+    Only records at min_level or above are limited, plus the ones with extra={'ratelimit_key': ...}.
+    The key is the message template (record.msg) or that ratelimit_key.
+    One instance can be shared by several handlers, a record is only counted once.
+    """
+
+    def __init__(self, burst: int = 5, interval: float = 60.0, min_level: int = logging.WARNING) -> None:
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.min_level = min_level
+        self._windows = {} # key -> [window start, records passed, records suppressed]
+        self._last = (None, True)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self._last[0] is record:
+            return self._last[1]
+        passed = self._filter(record)
+        self._last = (record, passed)
+        return passed
+
+    def _filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'ratelimit_key', None)
+        if key is None:
+            if record.levelno < self.min_level: # e.g. the DEBUG line of every decoded frame
+                return True
+            key = record.msg
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if suppressed:
+                record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+            if len(self._windows) > 1000: # keys are templates, this only happens with f-string messages
+                self._windows = {key: self._windows[key]}
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last capacity formatted lines in memory"""
+
+    def __init__(self, capacity: int = 500, level=logging.NOTSET) -> None:
+        super().__init__(level)
+        self.lines = collections.deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def dump(self, stream):
+        for line in list(self.lines):
+            stream.write(line)
+            stream.write('\n')
+
+
+def setup_logging(level='INFO', log_file: str = None, max_bytes: int = 256 * 1024, backup_count: int = 1,
+                  ring_size: int = 500, burst: int = 5, interval: float = 60.0) -> RingBufferHandler:
+    """Configure the root logger, logs to log_file (rotated at max_bytes) or stderr"""
+    global _ring_buffer
+    formatter = logging.Formatter(LOG_FORMAT)
+    if log_file:
+        sink = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+    else:
+        sink = logging.StreamHandler()
+    sink.setFormatter(formatter)
+    _ring_buffer = RingBufferHandler(ring_size)
+    _ring_buffer.setFormatter(formatter)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(sink)
+    root.addHandler(_ring_buffer)
+    rate_limit = RateLimitFilter(burst, interval)
+    for handler in root.handlers:
+        handler.addFilter(rate_limit)
+
+    # uncaught exceptions end up in the rotated log instead of an unbounded stderr redirect
+    sys.excepthook = lambda *exc_info: logging.critical('Uncaught exception', exc_info=exc_info)
+    return _ring_buffer
+
+
+def dump_ring_buffer(path: str = None) -> bool:
+    """Write the in-memory log lines to path, or stderr when path is None"""
+    if _ring_buffer is None:
+        return False
+    if path is None:
+        _ring_buffer.dump(sys.stderr)
+    else:
+        with open(path, 'w') as stream:
+            _ring_buffer.dump(stream)
+    logging.info('Dumped %d log lines to %s', len(_ring_buffer.lines), path or 'stderr')
+    return True
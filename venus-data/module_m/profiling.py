@@ -0,0 +1,104 @@
+"""On-demand profiling of the running service, triggered by signals.
+
+    kill -USR1 <pid>    start a cProfile capture, the second USR1 stops it and writes the stats
+    kill -USR2 <pid>    start tracing allocations, the second USR2 writes the growth since the first
+
+The files go to /data/module_m/ (profile-<time>.prof / .txt and memory-<time>.txt),
+open a .prof with `python3 -m pstats` or snakeviz. Nothing is hooked into the
+interpreter until a signal arrives, so the service runs at full speed otherwise.
+The profilers are imported on the first signal as well, they do not slow down the start.
+"""
+import logging
+import os
+import time
+
+PROFILE_DIR = '/data/module_m'
+
+
+def _stamp() -> str:
+    return time.strftime('%Y%m%d-%H%M%S')
+
+
+class Profiler:
+    """cProfile of everything the main loop runs between two toggle() calls"""
+
+    def __init__(self, directory: str = PROFILE_DIR, top: int = 40) -> None:
+        self.directory = directory
+        self.top = top
+        self._profile = None
+        self._started = None
+
+    def toggle(self, *args) -> bool:
+        if self._profile is None:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._started = time.monotonic()
+            self._profile.enable()
+            logging.info('Profiling started, send SIGUSR1 again to stop')
+        else:
+            self._profile.disable()
+            profile, self._profile = self._profile, None
+            try:
+                self._write(profile, time.monotonic() - self._started)
+            except OSError as e:
+                logging.error('Could not write the profile: %s', e)
+        return True # keep the signal handler installed
+
+    def _write(self, profile, seconds: float):
+        import io
+        import pstats
+        root = os.path.join(self.directory, f'profile-{_stamp()}')
+        profile.dump_stats(root + '.prof')
+        text = io.StringIO()
+        stats = pstats.Stats(profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        stats.sort_stats('tottime').print_stats(self.top)
+        with open(root + '.txt', 'w') as file:
+            file.write(f'{seconds:.1f} seconds profiled\n')
+            file.write(text.getvalue())
+        logging.info('Profiled %.1f seconds, stats written to %s.prof and .txt', seconds, root)
+
+
+class MemoryTracer:
+    """tracemalloc between two snapshot() calls, the difference is written by line"""
+
+    def __init__(self, directory: str = PROFILE_DIR, frames: int = 5, top: int = 30) -> None:
+        self.directory = directory
+        self.frames = frames
+        self.top = top
+        self._baseline = None
+
+    def snapshot(self, *args) -> bool:
+        import tracemalloc
+        if self._baseline is None:
+            tracemalloc.start(self.frames)
+            self._baseline = self._take()
+            logging.info('Tracing allocations, send SIGUSR2 again for the difference')
+            return True
+        baseline, self._baseline = self._baseline, None
+        current = self._take()
+        traced, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        path = os.path.join(self.directory, f'memory-{_stamp()}.txt')
+        try:
+            with open(path, 'w') as file:
+                file.write(f'traced {traced / 1024:.1f} kB, peak {peak / 1024:.1f} kB\n\n')
+                file.write(f'top {self.top} growth by line:\n')
+                for stat in current.compare_to(baseline, 'lineno')[:self.top]:
+                    file.write(f'{stat}\n')
+                file.write(f'\ntop {self.top} growth by traceback:\n')
+                for stat in current.compare_to(baseline, 'traceback')[:self.top]:
+                    file.write(f'{stat}\n')
+                    for line in stat.traceback.format():
+                        file.write(f'    {line}\n')
+            logging.info('Allocation difference written to %s', path)
+        except OSError as e:
+            logging.error('Could not write the allocation difference: %s', e)
+        return True # keep the signal handler installed
+
+    def _take(self):
+        import tracemalloc
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
@@ -0,0 +1,107 @@
+"""Declarative mapping of sample fields to D-Bus paths.
+
+A PathSpec lists the sample fields a path is computed from, the scale they are
+divided by, the sign rule, the rounding and the meter topology it applies to.
+compile_mapping() turns the specs into one generated function, like namedtuple
+generates its class: the sample is unpacked into locals once, every signed value
+is computed once, the topology is a single branch and the scales are constants.
+Mapping a sample is one call without looking at the specs again. A new quantity
+is one more PathSpec.
+
+    >>> mapping = compile_mapping([PathSpec('/Ac/L1/Power', ('P1',), scale=1000, sign=EXPORT)])
+    >>> print(mapping.source, end='')
+    def mapping(s):
+        timestamp, command, export_CT1, export_CT2, export_CT3, I1, I2, I3, U1, U2, U3, P1, P2, P3, energy_forward, energy_reverse = s
+        P1_signed = signed_power(P1, export_CT1)
+        values = {
+            '/Ac/L1/Power': P1_signed / 1000,
+        }
+        return values
+"""
+from module_m_decoder import SAMPLE_FIELDS, signed_power
+
+SINGLE_PHASE = 'single'
+THREE_PHASE = 'three'
+EXPORT = 'export' # the field of phase n is negated while export_CTn is set, see signed_power()
+
+# only L1 connected, the SINGLE_PHASE specs apply, otherwise the THREE_PHASE ones
+SINGLE_PHASE_CONDITION = 'I2 == 0 and I3 == 0 and U2 == 0 and U3 == 0'
+
+
+class PathSpec:
+    """One D-Bus path: the sum of fields divided by scale, rounded to digits when not None.
+
+    topology None applies to every meter, SINGLE_PHASE or THREE_PHASE only to that one.
+    unit names the text callback of the path (W, V, A or kWh).
+    """
+
+    def __init__(self, path: str, fields: tuple, scale: float = 1, sign: str = None, digits: int = None,
+                 topology: str = None, unit: str = None) -> None:
+        self.path = path
+        self.fields = tuple(fields)
+        self.scale = scale
+        self.sign = sign
+        self.digits = digits
+        self.topology = topology
+        self.unit = unit
+
+    def terms(self) -> list:
+        """Local variable names of the summed fields"""
+        for name in self.fields:
+            if name not in SAMPLE_FIELDS:
+                raise ValueError(f"{self.path}: unknown sample field {name}")
+            if self.sign == EXPORT and f'export_CT{name[-1]}' not in SAMPLE_FIELDS:
+                raise ValueError(f"{self.path}: {name} has no export flag")
+        if self.sign is not None and self.sign != EXPORT:
+            raise ValueError(f"{self.path}: unknown sign rule {self.sign}")
+        return [f'{name}_signed' if self.sign == EXPORT else name for name in self.fields]
+
+    def expression(self) -> str:
+        terms = self.terms()
+        expression = ' + '.join(terms)
+        if self.scale != 1:
+            expression = f'({expression}) / {self.scale!r}' if len(terms) > 1 else f'{expression} / {self.scale!r}'
+        if self.digits is not None:
+            expression = f'round({expression}, {self.digits})'
+        return expression
+
+
+def compile_mapping(specs):
+    """Function of a VictronSerialAmpsAndVoltage returning {path: value} of the specs"""
+    specs = list(specs)
+    lines = ['def mapping(s):', f"    {', '.join(SAMPLE_FIELDS)} = s"]
+    signed = {term for spec in specs for term in spec.terms() if term.endswith('_signed')}
+    for name in SAMPLE_FIELDS:
+        if f'{name}_signed' in signed:
+            lines.append(f'    {name}_signed = signed_power({name}, export_CT{name[-1]})')
+    lines.append('    values = {')
+    lines += [f'        {spec.path!r}: {spec.expression()},' for spec in specs if spec.topology is None]
+    lines.append('    }')
+    variants = {topology: [spec for spec in specs if spec.topology == topology] for topology in (SINGLE_PHASE, THREE_PHASE)}
+    if variants[SINGLE_PHASE] or variants[THREE_PHASE]:
+        for keyword, topology in ((f'if {SINGLE_PHASE_CONDITION}:', SINGLE_PHASE), ('else:', THREE_PHASE)):
+            lines.append(f'    {keyword}')
+            lines += [f'        values[{spec.path!r}] = {spec.expression()}' for spec in variants[topology]] or ['        pass']
+    lines.append('    return values')
+    source = '\n'.join(lines) + '\n'
+    namespace = {'signed_power': signed_power}
+    exec(compile(source, '<sample mapping>', 'exec'), namespace)
+    mapping = namespace['mapping']
+    mapping.source = source
+    return mapping
+
+
+# the sample fields are in mA, mV, mW and Wh
+METER_MAPPING = [
+    PathSpec('/Ac/Current', ('I1',), scale=1000, digits=3, topology=SINGLE_PHASE, unit='A'),
+    PathSpec('/Ac/Current', ('I1', 'I2', 'I3'), scale=1000, digits=3, topology=THREE_PHASE, unit='A'),
+    PathSpec('/Ac/Power', ('P1', 'P2', 'P3'), scale=1000, sign=EXPORT, unit='W'),
+    PathSpec('/Ac/Energy/Forward', ('energy_forward',), scale=1000, unit='kWh'),
+    PathSpec('/Ac/Energy/Reverse', ('energy_reverse',), scale=1000, unit='kWh'),
+]
+for _phase in '123':
+    METER_MAPPING += [
+        PathSpec(f'/Ac/L{_phase}/Voltage', (f'U{_phase}',), scale=1000, unit='V'),
+        PathSpec(f'/Ac/L{_phase}/Current', (f'I{_phase}',), scale=1000, unit='A'),
+        PathSpec(f'/Ac/L{_phase}/Power', (f'P{_phase}',), scale=1000, sign=EXPORT, unit='W'),
+    ]
@@ -0,0 +1,231 @@
+"""SMA Speedwire energy meter datagrams.
+
+A datagram is a chain of tag / length blocks after the "SMA\\0" signature:
+
+    "SMA\\0"
+    uint16 length, uint16 tag 0x02A0, uint32 group
+    uint16 length, uint16 tag 0x0010, uint16 protocol 0x6069, uint16 SUSy id, uint32 serial, uint32 ticker ms,
+        OBIS records: uint8 channel, uint8 index, uint8 type, uint8 tariff, value
+    uint16 0, uint16 0 (end)
+
+All numbers are big endian. The value of a record is 4 bytes for type 4 (actual
+value) and 8 bytes for type 8 (counter), the software version record 144.0.0.0
+has 4 bytes. The records are walked once and looked up by their 4 byte OBIS
+header, so any meter model or firmware layout is read without fixed offsets.
+
+SpeedwireBroadcaster goes the other way: it packs every Module M sample into an
+energy meter datagram with one precompiled struct and multicasts it, so any
+Speedwire consumer on the network gets the readings for one UDP send per frame.
+"""
+import logging
+import re
+import socket
+import struct
+import zlib
+
+MULTICAST_GROUP = '239.12.255.254'
+PORT = 9522
+SIGNATURE = b'SMA\x00'
+PROTOCOL_EMETER = 0x6069
+TAG_GROUP = 0x02A0
+TAG_DATA = 0x0010
+MAX_DATAGRAM = 1024
+
+TAG = struct.Struct(">HH") # length, tag
+DATA_HEADER = struct.Struct(">HHII") # protocol, SUSy id, serial, ticker
+OBIS = struct.Struct(">I")
+VALUE_32 = struct.Struct(">I")
+VALUE_64 = struct.Struct(">Q")
+TYPE_ACTUAL = 4
+TYPE_COUNTER = 8
+VERSION_CHANNEL = 144
+
+
+def obis(index: int, kind: int, tariff: int = 0, channel: int = 0) -> int:
+    """The 4 byte OBIS record header as an int, e.g. 00 01 04 00 for the total active power import"""
+    return channel << 24 | index << 16 | kind << 8 | tariff
+
+
+# OBIS header -> (D-Bus path, divisor, sign), records of the same path are added up,
+# so the import and export measurements give the signed power
+OBIS_PATHS = {}
+for _prefix, _offset in (('/Ac', 0), ('/Ac/L1', 20), ('/Ac/L2', 40), ('/Ac/L3', 60)):
+    OBIS_PATHS[obis(_offset + 1, TYPE_ACTUAL)] = (f'{_prefix}/Power', 10, 1) # 0.1 W
+    OBIS_PATHS[obis(_offset + 2, TYPE_ACTUAL)] = (f'{_prefix}/Power', 10, -1)
+    OBIS_PATHS[obis(_offset + 1, TYPE_COUNTER)] = (f'{_prefix}/Energy/Forward', 3600000, 1) # Ws -> kWh
+    OBIS_PATHS[obis(_offset + 2, TYPE_COUNTER)] = (f'{_prefix}/Energy/Reverse', 3600000, 1)
+    if _offset:
+        OBIS_PATHS[obis(_offset + 11, TYPE_ACTUAL)] = (f'{_prefix}/Current', 1000, 1) # mA
+        OBIS_PATHS[obis(_offset + 12, TYPE_ACTUAL)] = (f'{_prefix}/Voltage', 1000, 1) # mV
+
+
+class SpeedwireError(ValueError):
+    pass
+
+
+def parse(data, length: int = None):
+    """Parse an energy meter datagram from data[:length].
+
+    Returns (serial, {OBIS header: raw value}), raises SpeedwireError for other
+    datagrams, like the inverter traffic on the same multicast group.
+    """
+    if length is None:
+        length = len(data)
+    if length < 4 + TAG.size or data[:4] != SIGNATURE:
+        raise SpeedwireError('not a Speedwire datagram')
+    offset = 4
+    while offset + TAG.size <= length:
+        size, tag = TAG.unpack_from(data, offset)
+        offset += TAG.size
+        if tag == 0 and size == 0: # end of the datagram
+            break
+        if offset + size > length:
+            raise SpeedwireError('truncated datagram')
+        if tag == TAG_DATA:
+            return _parse_data(data, offset, offset + size)
+        offset += size
+    raise SpeedwireError('no energy meter data')
+
+
+def _parse_data(data, offset: int, end: int):
+    if end - offset < DATA_HEADER.size:
+        raise SpeedwireError('truncated energy meter data')
+    protocol, _, serial, _ = DATA_HEADER.unpack_from(data, offset)
+    if protocol != PROTOCOL_EMETER:
+        raise SpeedwireError(f'protocol 0x{protocol:04x} is not an energy meter')
+    if serial == 0xFFFFFFFF:
+        raise SpeedwireError('invalid serial number')
+    offset += DATA_HEADER.size
+    records = {}
+    while offset + OBIS.size <= end:
+        header, = OBIS.unpack_from(data, offset)
+        offset += OBIS.size
+        kind = header >> 8 & 0xFF
+        if kind == TYPE_COUNTER:
+            if offset + 8 > end:
+                break
+            records[header], = VALUE_64.unpack_from(data, offset)
+            offset += 8
+        elif kind == TYPE_ACTUAL or header >> 24 == VERSION_CHANNEL:
+            if offset + 4 > end:
+                break
+            records[header], = VALUE_32.unpack_from(data, offset)
+            offset += 4
+        else: # unknown record size, the rest can not be read
+            break
+    return serial, records
+
+
+def dbus_values(records: dict) -> dict:
+    """D-Bus path values of the parsed records, /Ac/Current is the sum of the phase currents"""
+    values = {}
+    for header, value in records.items():
+        mapping = OBIS_PATHS.get(header)
+        if mapping is not None:
+            path, divisor, sign = mapping
+            values[path] = values.get(path, 0) + sign * value / divisor
+    currents = [values[path] for path in ('/Ac/L1/Current', '/Ac/L2/Current', '/Ac/L3/Current') if path in values]
+    if currents:
+        values['/Ac/Current'] = sum(currents)
+    return values
+
+
+# records of the datagrams we send: (OBIS header, struct format), in the order of the meters
+_RECORDS = []
+for _offset in (0, 20, 40, 60):
+    _RECORDS += [(obis(_offset + 1, TYPE_ACTUAL), 'I'), (obis(_offset + 1, TYPE_COUNTER), 'Q'),
+                 (obis(_offset + 2, TYPE_ACTUAL), 'I'), (obis(_offset + 2, TYPE_COUNTER), 'Q')]
+    if _offset: # current and voltage of the phase
+        _RECORDS += [(obis(_offset + 11, TYPE_ACTUAL), 'I'), (obis(_offset + 12, TYPE_ACTUAL), 'I')]
+_RECORDS.append((obis(0, 0, channel=VERSION_CHANNEL), 'I')) # 90 00 00 00
+_DATA_SIZE = DATA_HEADER.size + sum(4 + struct.calcsize('>' + fmt) for _, fmt in _RECORDS)
+DATAGRAM = struct.Struct('>4sHHI' + 'HH' + 'HHII' + ''.join('I' + fmt for _, fmt in _RECORDS) + 'HH')
+SOFTWARE_VERSION = 0x01000052 # 1.0.0.R
+SUSY_ID = 0x0174 # the SUSy id of the Home Manager 2.0
+
+
+def speedwire_serial(serialnumber) -> int:
+    """32 bit Speedwire serial number of a Module M serial number (bytes or str)"""
+    if isinstance(serialnumber, bytes):
+        serialnumber = serialnumber.decode('utf-8', errors='replace')
+    digits = re.sub(r'\D', '', serialnumber)
+    if digits and int(digits) < 0xFFFFFFFF:
+        return int(digits)
+    return zlib.crc32(serialnumber.encode()) & 0x7FFFFFFF
+
+
+def encode(sample, serial: int, ticker: int, phase_energy=None, susy_id: int = SUSY_ID) -> bytes:
+    """Energy meter datagram of a VictronSerialAmpsAndVoltage.
+
+    phase_energy is ((forward, reverse) Wh per phase), see EnergyIntegrator.phase_energy,
+    without it the phase counters are 0.
+    """
+    powers = list(sample.signed_powers())
+    powers.insert(0, sum(powers))
+    energy = [(sample.energy_forward, sample.energy_reverse)] + list(phase_energy or ((0, 0), (0, 0), (0, 0)))
+    phases = (None, (sample.I1, sample.U1), (sample.I2, sample.U2), (sample.I3, sample.U3))
+    values = []
+    for power, (forward, reverse), phase in zip(powers, energy, phases):
+        # the sample power is in mW (the service publishes P / 1000 as W), Speedwire uses 0.1 W
+        values += [max(power, 0) // 100, int(forward * 3600), max(-power, 0) // 100, int(reverse * 3600)]
+        if phase is not None:
+            values += phase # mA, mV
+    values.append(SOFTWARE_VERSION)
+    fields = [SIGNATURE, 4, TAG_GROUP, 1, _DATA_SIZE, TAG_DATA, PROTOCOL_EMETER, susy_id, serial, ticker & 0xFFFFFFFF]
+    for (header, _), value in zip(_RECORDS, values):
+        fields += [header, value]
+    fields += [0, 0]
+    return DATAGRAM.pack(*fields)
+
+
+class SpeedwireBroadcaster:
+    """Multicasts a Speedwire datagram per sample, loop=True also delivers it on this host (tests)"""
+
+    def __init__(self, serial: int = None, group: str = MULTICAST_GROUP, port: int = PORT, interface: str = '0.0.0.0',
+                 ttl: int = 1, loop: bool = False) -> None:
+        self.serial = serial
+        self.address = (group, port)
+        self.sent = 0
+        self.errors = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 if loop else 0)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.sock.setblocking(False) # a full send buffer drops the datagram instead of stalling the main loop
+
+    def send(self, sample, phase_energy=None) -> bool:
+        if self.serial is None:
+            return False
+        data = encode(sample, self.serial, int(sample.timestamp * 1000), phase_energy)
+        try:
+            self.sock.sendto(data, self.address)
+        except OSError as e:
+            self.errors += 1
+            logging.warning("Could not send the Speedwire datagram: %s", e)
+            return False
+        self.sent += 1
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    # prints the energy meter datagrams on the network, e.g. to check the broadcaster over loopback:
+    # python3 speedwire.py 127.0.0.1 with [speedwire] interface = 127.0.0.1 and loop = yes
+    import sys
+    interface = sys.argv[1] if len(sys.argv) > 1 else '0.0.0.0'
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', PORT))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    struct.pack("4s4s", socket.inet_aton(MULTICAST_GROUP), socket.inet_aton(interface)))
+    buffer = bytearray(MAX_DATAGRAM)
+    while True:
+        length = sock.recv_into(buffer)
+        try:
+            serial, records = parse(buffer, length)
+        except SpeedwireError as e:
+            print(e)
+            continue
+        print(serial, dbus_values(records))
@@ -0,0 +1,145 @@
+"""Runtime counters and latency histograms of the Module M service.
+
+The counters are plain ints on ModuleM and DbusENERTYService, Histogram
+counts observations in fixed buckets, so recording costs an int increment or a
+bisect. They are published under /Mgmt/Stats on D-Bus and as Prometheus text
+on an optional Unix socket:
+
+    curl --unix-socket /tmp/module_m_metrics.sock http://localhost/metrics
+"""
+import bisect
+import logging
+import os
+import socket
+
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0) # seconds
+AGE_BUCKETS = (0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0) # seconds
+
+
+class Histogram:
+
+    def __init__(self, bounds=LATENCY_BUCKETS) -> None:
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1) # the last bucket is everything above the last bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding the q quantile, None without observations"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+
+def _labels(labels: dict, extra: str = '') -> str:
+    items = [f'{key}="{value}"' for key, value in labels.items()]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+def format_prometheus(metrics) -> str:
+    """Prometheus text of (name, help, labels, value or Histogram) tuples, counters end in _total.
+
+    The tuples of several meters can be mixed, every metric is written as one block.
+    """
+    families = {}
+    for metric in metrics:
+        families.setdefault(metric[0], []).append(metric)
+    lines = []
+    for name, family in families.items():
+        description, value = family[0][1], family[0][3]
+        kind = 'histogram' if isinstance(value, Histogram) else 'counter' if name.endswith('_total') else 'gauge'
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for _, _, labels, value in family:
+            lines += _samples(name, labels, value)
+    return '\n'.join(lines) + '\n'
+
+
+def _samples(name: str, labels: dict, value) -> list:
+    lines = []
+    if isinstance(value, Histogram):
+        cumulative = 0
+        for bound, count in zip(value.bounds + ('+Inf',), value.counts):
+            cumulative += count
+            bucket = _labels(labels, 'le="%s"' % bound)
+            lines.append(f'{name}_bucket{bucket} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {value.sum}')
+        lines.append(f'{name}_count{_labels(labels)} {value.count}')
+    elif value is not None:
+        lines.append(f'{name}{_labels(labels)} {value}')
+    return lines
+
+
+class MetricsServer:
+    """Answers every connection on a Unix socket with the Prometheus text of collect(), then closes it.
+
+    The answer has an HTTP header, so curl --unix-socket works as well as socat.
+    The request is read before answering: closing with unread bytes resets the
+    connection and the client can lose the answer.
+    Add fileno() to the main loop and call handle() when it is readable.
+    """
+
+    REQUEST_TIMEOUT = 0.2 # seconds to wait for the request, socat without input sends none
+    MAX_REQUEST = 4096
+
+    def __init__(self, path: str, collect) -> None:
+        self.path = path
+        self.collect = collect
+        if os.path.exists(path):
+            os.unlink(path) # left over from a previous run
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(4)
+        self.sock.setblocking(False)
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def handle(self) -> bool:
+        try:
+            client, _ = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return True
+        try:
+            self._read_request(client)
+            client.settimeout(1)
+            body = format_prometheus(self.collect()).encode()
+            client.sendall(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                           b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            client.shutdown(socket.SHUT_WR)
+        except OSError as e:
+            logging.warning("Could not send the metrics: %s", e)
+        finally:
+            client.close()
+        return True
+
+    def _read_request(self, client):
+        """Read up to the end of the request header, EOF or REQUEST_TIMEOUT"""
+        client.settimeout(self.REQUEST_TIMEOUT)
+        request = b''
+        try:
+            while b'\r\n\r\n' not in request and len(request) < self.MAX_REQUEST:
+                data = client.recv(self.MAX_REQUEST)
+                if not data:
+                    break
+                request += data
+        except socket.timeout:
+            pass
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -62,6 +62,14 @@ logMessage ()
 
 logMessage "starting"
 
+# nothing to do when the archive holds the release that is installed already, see zip_file.py
+manifest="/data/module_m/MANIFEST"
+if [ -f "$manifest" ] && cmp -s "$manifest" "/data/module_m/.installed-manifest"; then
+	logMessage "module_m is up to date, skipping install.sh"
+	logMessage "completed"
+	exit 0
+fi
+
 # run the blind install script from the SetupHelper-blind
 script="/data/module_m/install.sh"
 if [ -f "$script" ]; then
@@ -1,27 +1,214 @@
-import tarfile
+"""Builds venus-data.tgz, the archive Venus OS unpacks into /data from a USB stick or SD card.
+
+The archive is reproducible: members are sorted, owned by root, have fixed
+modes and mtimes (SOURCE_DATE_EPOCH when set) and the gzip header carries no
+time or file name, so the same sources always give the same bytes.
+
+The modules are precompiled into module_m/__pycache__ with checked-hash .pyc
+files, so the GX does not compile them on the first start and still picks up a
+source edited on the device. The bytecode is specific to the Python version:
+build with the interpreter of the Venus OS release (--python python3.8). The
+build fails when that interpreter is not TARGET_PYTHON (--target-python for
+another release), a .pyc of another version would be ignored on the GX. The
+compiled files are cached by the hash of their source in .build-cache/.
+
+module_m/MANIFEST lists the sha256 of every file in sha256sum format. The
+archive is only rewritten when the manifest changed, and install.sh /
+post-hook.sh compare it with the installed one to skip an unchanged update
+and to remove files a release dropped.
+
+    python3 zip_file.py [--python python3.8] [--target-python 3.8] [--no-compile]
+"""
+import argparse
+import gzip
+import hashlib
+import io
 import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+INSTALL_DIR = '/data' # where Venus OS unpacks the archive
+TARGET_PYTHON = '3.8' # Python of the Venus OS release, the .pyc files only load with that version
+MANIFEST = 'module_m/MANIFEST'
+CACHE_DIR = '.build-cache'
+DEFAULT_MTIME = 1704067200 # 2024-01-01, used without SOURCE_DATE_EPOCH
+EXCLUDE_DIRS = ('__pycache__',)
+EXCLUDE_SUFFIXES = ('.pyc', '.pyo')
+NOT_COMPILED = ('dbus-homemanager.py',) # run as __main__, Python never loads the script from a .pyc
+
+# run by the target interpreter: source, pyc and installed path triples in argv
+_COMPILE = """
+import py_compile, sys
+for source, cfile, dfile in zip(*[iter(sys.argv[1:])] * 3):
+    py_compile.compile(source, cfile, dfile, doraise=True, invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)
+"""
+
+
+def source_files(folder_name: str) -> dict:
+    """archive name -> path of every file in folder_name, without caches and hidden files"""
+    files = {}
+    for root, dirs, names in os.walk(folder_name):
+        dirs[:] = [name for name in dirs if name not in EXCLUDE_DIRS and not name.startswith('.')]
+        for name in names:
+            if name.startswith('.') or name.endswith(EXCLUDE_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, folder_name).replace(os.sep, '/')] = path
+    return files
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def python_version(python: str) -> str:
+    """major.minor version of the python executable"""
+    return subprocess.run([python, '-c', 'import sys; print("%d.%d" % sys.version_info[:2])'],
+                          check=True, capture_output=True, text=True).stdout.strip()
+
 
-def create_tgz(folder_name, output_name):
+def compile_modules(sources: dict, python: str, cache_dir: str = CACHE_DIR) -> dict:
+    """archive name -> checked-hash .pyc bytes of the .py sources, compiled by the python executable.
+
+    A module is only compiled again when its source or the interpreter changed.
+    """
+    tag = subprocess.run([python, '-c', 'import sys; print(sys.implementation.cache_tag)'],
+                         check=True, capture_output=True, text=True).stdout.strip()
+    os.makedirs(cache_dir, exist_ok=True)
+    compiled = {}
+    missing = {}
+    for name, data in sources.items():
+        if not name.endswith('.py') or os.path.basename(name) in NOT_COMPILED:
+            continue
+        directory, module = os.path.split(name)
+        pyc_name = f"{directory}/__pycache__/{module[:-3]}.{tag}.pyc"
+        key = _sha256(name.encode() + b'\0' + data) # the path is in the .pyc as well
+        cached = os.path.join(cache_dir, f"{key}.{tag}.pyc")
+        if os.path.exists(cached):
+            with open(cached, 'rb') as file:
+                compiled[pyc_name] = file.read()
+        else:
+            missing[name] = (pyc_name, cached)
+    if missing:
+        with tempfile.TemporaryDirectory() as stage:
+            arguments = []
+            for index, name in enumerate(sorted(missing)):
+                source = os.path.join(stage, f'{index}.py')
+                with open(source, 'wb') as file:
+                    file.write(sources[name])
+                # tracebacks on the GX show the installed path instead of the build directory
+                arguments += [source, os.path.join(stage, f'{index}.pyc'), f'{INSTALL_DIR}/{name}']
+            subprocess.run([python, '-c', _COMPILE, *arguments], check=True)
+            for index, name in enumerate(sorted(missing)):
+                pyc_name, cached = missing[name]
+                shutil.copyfile(os.path.join(stage, f'{index}.pyc'), cached)
+                with open(cached, 'rb') as file:
+                    compiled[pyc_name] = file.read()
+        print(f"compiled {len(missing)} modules for {tag}, {len(compiled) - len(missing)} unchanged")
+    return compiled
+
+
+def manifest(members: dict) -> bytes:
+    return ''.join(f"{_sha256(members[name])}  {name}\n" for name in sorted(members)).encode()
+
+
+def _archived_manifest(output_name: str):
+    try:
+        with tarfile.open(output_name, 'r:gz') as tar:
+            member = tar.extractfile(MANIFEST)
+            return member.read() if member is not None else None
+    except (OSError, tarfile.TarError, KeyError):
+        return None
+
+
+def _info(name: str, mtime: int, size: int = 0, directory: bool = False) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = 'root'
+    if directory:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    else:
+        info.size = size
+        info.mode = 0o755 if name.endswith('.sh') else 0o644
+    return info
+
+
+def write_archive(members: dict, output_name: str, mtime: int):
+    """Reproducible tar.gz of members (archive name -> bytes), replaces output_name atomically"""
+    directories = set()
+    for name in members:
+        parts = name.split('/')[:-1]
+        directories.update('/'.join(parts[:index + 1]) for index in range(len(parts)))
+    entries = sorted([(name, True) for name in directories] + [(name, False) for name in members])
+    temporary = output_name + '.tmp'
+    with open(temporary, 'wb') as raw:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0, compresslevel=9) as compressed:
+            with tarfile.open(fileobj=compressed, mode='w', format=tarfile.GNU_FORMAT) as tar:
+                for name, directory in entries:
+                    if directory:
+                        tar.addfile(_info(name + '/', mtime, directory=True))
+                    else:
+                        data = members[name]
+                        tar.addfile(_info(name, mtime, len(data)), io.BytesIO(data))
+    os.replace(temporary, output_name)
+
+
+def create_tgz(folder_name, output_name, python: str = None, compile_bytecode: bool = True,
+               target_python: str = TARGET_PYTHON):
     """
-    Creates a .tgz archive from the contents of a folder.
-    
+    Creates a reproducible .tgz archive from the contents of a folder.
+
     :param folder_name: Name of the folder whose contents will be archived
     :param output_name: Name of the output .tgz file
+    :param python: interpreter the modules are compiled with, the one running this script by default
+    :param compile_bytecode: add the .pyc files of the modules
+    :param target_python: major.minor version python has to be, the one of the Venus OS release
     """
     if not os.path.isdir(folder_name):
         print(f"Error: Folder '{folder_name}' does not exist.")
-        return
+        return False
+    python = python or sys.executable
+    if compile_bytecode:
+        try:
+            version = python_version(python)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Error: Could not run '{python}': {e}")
+            return False
+        if version != target_python:
+            print(f"Error: '{python}' is Python {version}, Venus OS runs Python {target_python}. "
+                  f"Build with --python python{target_python} or --no-compile.")
+            return False
+
+    members = {}
+    for name, path in source_files(folder_name).items():
+        with open(path, 'rb') as file:
+            members[name] = file.read()
+    members.pop(MANIFEST, None)
+    if compile_bytecode:
+        members.update(compile_modules(members, python))
+    members[MANIFEST] = manifest(members)
 
-    with tarfile.open(output_name, "w:gz") as tar:
-        # Add each item in the folder to the archive
-        for item in os.listdir(folder_name):
-            item_path = os.path.join(folder_name, item)
-            tar.add(item_path, arcname=item)  # Use the item name only
-    print(f"'{output_name}' has been created successfully.")
+    if _archived_manifest(output_name) == members[MANIFEST]:
+        print(f"'{output_name}' is up to date.")
+        return True
+    mtime = int(os.environ.get('SOURCE_DATE_EPOCH', DEFAULT_MTIME))
+    write_archive(members, output_name, mtime)
+    print(f"'{output_name}' has been created successfully ({len(members)} files, sha256 "
+          f"{_sha256(open(output_name, 'rb').read())[:16]}).")
+    return True
 
-# Define the folder and output file name
-folder_to_zip = "venus-data"
-output_tgz_file = "venus-data.tgz"
 
-# Create the .tgz file
-create_tgz(folder_to_zip, output_tgz_file)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the reproducible venus-data.tgz release archive')
+    parser.add_argument('--source', default='venus-data', help='folder to archive')
+    parser.add_argument('--output', default='venus-data.tgz')
+    parser.add_argument('--python', help='interpreter of the Venus OS release to compile with, e.g. python3.8')
+    parser.add_argument('--target-python', default=TARGET_PYTHON, help=f'Python version of the Venus OS release, {TARGET_PYTHON} by default')
+    parser.add_argument('--no-compile', action='store_true', help='ship the sources only')
+    args = parser.parse_args()
+    sys.exit(0 if create_tgz(args.source, args.output, args.python, not args.no_compile, args.target_python) else 1)